@@ -0,0 +1,335 @@
+"""
+Requests to the OpenAI api, made in process or through the hey daemon.
+
+The daemon (hey --daemon) keeps one OpenAI client, with its connection pool,
+alive between runs, so a prompt doesn't pay for importing openai and opening
+a new TLS connection each time. Runs talk to it over a Unix socket, and make
+the request themselves if it isn't running.
+
+get_policy_texts wraps requests with per attempt timeouts, retries with backoff
+and optional hedging, all within an overall deadline.
+"""
+
+import json
+import os
+import queue
+import random
+import socket
+import socketserver
+import threading
+import time
+
+model = "gpt-4o"
+
+# Seconds a streamed attempt has to send its first text before another is made,
+# set with HEY_ATTEMPT_TIMEOUT
+attempt_timeout = float(os.environ.get("HEY_ATTEMPT_TIMEOUT", 30))
+
+# Attempts made at a reply when rate limited, the server errors or an attempt times out
+max_attempts = 5
+
+# Seconds of the first backoff, doubled for each retry after
+backoff_base = 1
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+data_dir = os.environ.get("HEY_DATA_DIR", script_dir)
+socket_path = os.path.join(data_dir, "hey.sock")
+
+# OpenAI client, made on the first request so startup doesn't pay for importing openai
+client = None
+
+
+def get_client():
+    """
+    Returns the OpenAI client, creating it the first time it is needed.
+    """
+    global client
+    if client is None:
+        from openai import OpenAI
+
+        # Retries are made by get_policy_texts, within its deadline
+        client = OpenAI(max_retries=0)
+    return client
+
+
+def get_stream_text(completion):
+    """
+    Yields the text of each chunk in a streamed completion.
+    """
+    for chunk in completion:
+        if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+def create_texts(messages, stream=False):
+    """
+    Requests a reply to the messages in this process, yielding its text as it
+    arrives when streaming, or all at once when not.
+    """
+    if stream:
+        completion = get_client().chat.completions.create(
+            model=model, messages=messages, stream=True
+        )
+        yield from get_stream_text(completion)
+    else:
+        completion = get_client().chat.completions.create(
+            model=model, messages=messages
+        )
+        yield completion.choices[0].message.content
+
+
+def get_completion_texts(messages, stream=False):
+    """
+    Requests a reply to the messages through the daemon if it is running,
+    otherwise in this process. Yields the reply's text like create_texts.
+    """
+    daemon = connect_daemon()
+    if daemon is None:
+        return create_texts(messages, stream)
+    return get_daemon_texts(daemon, messages, stream)
+
+
+def is_retryable(e):
+    """
+    Returns whether a failed request is worth retrying, ie it was rate limited,
+    the server had an error, or the connection failed.
+    """
+    status_code = getattr(e, "status_code", None)
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+    return type(e).__name__ in ("APIConnectionError", "APITimeoutError")
+
+
+# Request Policy ==================================================================
+
+
+def get_policy_texts(
+    messages, stream=False, deadline=None, hedge_delay=None, attempts=None
+):
+    """
+    Requests a reply like get_completion_texts, yielding its text as it arrives, but:
+
+    - When streaming, each attempt has attempt_timeout seconds to send its first text
+      before another is made in its place.
+    - Attempts that are rate limited or hit a server error are retried after an
+      exponential backoff with jitter.
+    - If hedge_delay is given and the first streamed attempt has sent nothing after
+      that many seconds, a second is made alongside it and whichever answers first
+      is used.
+    - Nothing is started or waited for past deadline (a time.monotonic value),
+      TimeoutError is raised instead.
+
+    A reply that isn't streamed only sends text once it's finished, however long it
+    is, so its attempts are only limited by the deadline and are never hedged.
+
+    If attempts is given, a record of each attempt is added to it.
+    """
+    if attempts is None:
+        attempts = []
+    timeout = attempt_timeout if stream else None
+    if not stream:
+        hedge_delay = None
+    pieces = queue.Queue()
+    stopped = threading.Event()
+    state = {"chosen": None}
+
+    # Attempt index to when it started, for attempts still waiting on a reply
+    running = {}
+
+    def run_attempt(index):
+        try:
+            for text in get_completion_texts(messages, stream):
+                if stopped.is_set() or state["chosen"] not in (None, index):
+                    return
+                pieces.put((index, "text", text))
+            pieces.put((index, "done", None))
+        except Exception as e:
+            pieces.put((index, "error", e))
+
+    def start_attempt(is_hedge=False):
+        index = len(attempts)
+        attempts.append(
+            {"attempt": index + 1, "hedge": is_hedge, "ms": None, "outcome": None}
+        )
+        running[index] = time.monotonic()
+        threading.Thread(target=run_attempt, args=(index,), daemon=True).start()
+
+    def end_attempt(index, outcome):
+        attempts[index]["ms"] = round((time.monotonic() - running.pop(index)) * 1000)
+        attempts[index]["outcome"] = outcome
+
+    retry_at = None
+    last_error = None
+    is_hedged = False
+    start_attempt()
+
+    try:
+        while True:
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                for index in list(running):
+                    end_attempt(index, "deadline")
+                raise TimeoutError("No reply before the deadline")
+
+            wake_times = [] if deadline is None else [deadline]
+            if state["chosen"] is None:
+                for index, started in list(running.items()):
+                    if timeout is None:
+                        continue
+                    if now - started >= timeout:
+                        end_attempt(index, "timeout")
+                    else:
+                        wake_times.append(started + timeout)
+
+                # Nothing is left to wait on, so make another attempt or give up
+                if len(running) == 0 and retry_at is None:
+                    if len(attempts) >= max_attempts:
+                        raise last_error or TimeoutError("Every attempt timed out")
+                    start_attempt()
+                elif retry_at is not None and now >= retry_at:
+                    retry_at = None
+                    start_attempt()
+                elif retry_at is not None:
+                    wake_times.append(retry_at)
+
+                if hedge_delay is not None and not is_hedged and len(running) == 1:
+                    started = list(running.values())[0]
+                    if now - started >= hedge_delay:
+                        is_hedged = True
+                        start_attempt(is_hedge=True)
+                    else:
+                        wake_times.append(started + hedge_delay)
+
+            wait = min(wake_times) - now if wake_times else None
+            try:
+                index, kind, value = pieces.get(
+                    timeout=None if wait is None else max(0.01, wait)
+                )
+            except queue.Empty:
+                continue
+
+            # Attempts that timed out or lost a hedge are ignored from then on
+            if index not in running:
+                continue
+
+            if kind == "text":
+                if state["chosen"] is None:
+                    state["chosen"] = index
+                    for other in list(running):
+                        if other != index:
+                            end_attempt(other, "lost")
+                yield value
+
+            elif kind == "done":
+                end_attempt(index, "ok")
+                return
+
+            elif kind == "error":
+                end_attempt(index, type(value).__name__ + ": " + str(value))
+                last_error = value
+
+                # Text has been given out already, so it can't be started over
+                if state["chosen"] == index or not is_retryable(value):
+                    raise value
+                if len(running) > 0:
+                    continue
+                if len(attempts) >= max_attempts:
+                    raise value
+
+                # Exponential backoff with jitter, given up on if it would pass the deadline
+                retries = len([a for a in attempts if not a["hedge"]]) - 1
+                retry_at = now + random.uniform(0, backoff_base * 2**retries)
+                if deadline is not None and retry_at >= deadline:
+                    raise value
+    finally:
+        stopped.set()
+
+
+class DaemonError(RuntimeError):
+    """
+    A request made through the daemon failed, with the status code of the api
+    error if there was one.
+    """
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+# Daemon ==========================================================================
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """
+    Handles one request to the daemon. The request is a line of json with the
+    messages, and the reply is sent back as a line of json per piece of text.
+    """
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        try:
+            for text in create_texts(request["messages"], request["stream"]):
+                self.send({"text": text})
+            self.send({"done": True})
+        except (BrokenPipeError, ConnectionResetError):
+            # The run went away (Ctrl-C, or a hedge that lost), so there's no one to tell
+            return
+        except Exception as e:
+            self.send({"error": str(e), "status_code": getattr(e, "status_code", None)})
+
+    def send(self, data):
+        self.wfile.write((json.dumps(data) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+
+def serve_daemon():
+    """
+    Runs the daemon until it is interrupted.
+    """
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    # Warm up the client, so the first request doesn't pay for it
+    get_client()
+
+    with socketserver.ThreadingUnixStreamServer(socket_path, DaemonHandler) as server:
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+
+def connect_daemon():
+    """
+    Returns a socket connected to the daemon, or None if it isn't running.
+    """
+    if not os.path.exists(socket_path):
+        return None
+
+    daemon = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        daemon.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        daemon.close()
+        return None
+    return daemon
+
+
+def get_daemon_texts(daemon, messages, stream=False):
+    """
+    Sends messages to the daemon, yielding the reply's text as it comes back.
+    """
+    with daemon, daemon.makefile("rwb") as f:
+        request = {"messages": messages, "stream": stream}
+        f.write((json.dumps(request) + "\n").encode("utf-8"))
+        f.flush()
+
+        for line in f:
+            data = json.loads(line)
+            if "error" in data:
+                raise DaemonError(data["error"], data.get("status_code"))
+            if data.get("done"):
+                return
+            yield data["text"]
+
+    raise DaemonError("The hey daemon closed the connection before replying")
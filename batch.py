@@ -0,0 +1,107 @@
+"""
+Batch mode, replying to many prompts at once (hey --batch prompts.txt).
+
+Prompts are read one per line, either as plain text or as json objects with a
+"prompt" key, from a file or from stdin. Requests are made concurrently, and
+the replies are printed in the same order as the prompts.
+"""
+
+import asyncio
+import json
+import os
+import sys
+from api import get_policy_texts
+from utils import get_time_ms, save_chats
+
+# Requests in flight at once, set with HEY_BATCH_CONCURRENCY
+batch_concurrency = int(os.environ.get("HEY_BATCH_CONCURRENCY", 4))
+
+
+def read_prompts(path=""):
+    """
+    Reads the prompts from the file at path, or stdin if no path is given.
+    """
+    f = open(path, "r") if path else sys.stdin
+    prompts = []
+    try:
+        for line in f:
+            line = line.strip()
+            if line == "":
+                continue
+            if line.startswith("{"):
+                try:
+                    prompts.append(json.loads(line)["prompt"])
+                    continue
+                except (ValueError, KeyError):
+                    pass
+            prompts.append(line)
+    finally:
+        if path:
+            f.close()
+
+    return prompts
+
+
+async def get_batch_reply(prompt, limit):
+    """
+    Requests a reply to one prompt, retried by get_policy_texts when rate limited.
+    Returns the result as a dict with the prompt and either its reply or the error.
+    """
+    async with limit:
+        user_time = get_time_ms()
+        messages = [{"role": "user", "content": prompt}]
+        try:
+            reply = await asyncio.to_thread(lambda: "".join(get_policy_texts(messages)))
+        except Exception as e:
+            return {"prompt": prompt, "error": str(e)}
+
+        return {
+            "prompt": prompt,
+            "reply": reply,
+            "user_time": user_time,
+            "ai_time": get_time_ms(),
+        }
+
+
+def print_result(result, output_format):
+    if output_format == "markdown":
+        print("## " + result["prompt"] + "\n")
+        print(result.get("reply", "Error: " + result.get("error", "")) + "\n")
+    else:
+        line = {"prompt": result["prompt"]}
+        if "reply" in result:
+            line["reply"] = result["reply"]
+        else:
+            line["error"] = result["error"]
+        print(json.dumps(line), flush=True)
+
+
+async def run_batch_async(prompts, output_format):
+    limit = asyncio.Semaphore(max(1, batch_concurrency))
+    tasks = [asyncio.create_task(get_batch_reply(prompt, limit)) for prompt in prompts]
+
+    # Print each result as soon as those before it are done
+    results = []
+    for task in tasks:
+        result = await task
+        print_result(result, output_format)
+        results.append(result)
+
+    return results
+
+
+def run_batch(path="", output_format="jsonl"):
+    """
+    Replies to every prompt in the file (or stdin), printing the replies as jsonl
+    or markdown, then saves all the exchanges as new chats in one write.
+    """
+    prompts = read_prompts(path)
+    results = asyncio.run(run_batch_async(prompts, output_format))
+
+    save_chats(
+        [
+            (result["prompt"], result["reply"], result["user_time"], result["ai_time"])
+            for result in results
+            if "reply" in result
+        ]
+    )
@@ -0,0 +1,559 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for hey, run against a local stand-in for the OpenAI chat completions api.
+
+Usage:
+    python bench.py [--sizes 100,10000,100000] [--output results.json] [--compare old.json]
+    python bench.py --startup-only [--startup-budget-ms 500]
+
+Measures:
+    - cold startup of `hey -h` and of drawing the browse screen
+    - time to first token and end to end time of an inline reply, streamed, not
+      streamed and through the daemon
+    - markdown render throughput, uncached and cached
+    - save_chat cost, chat index load time and browse redraw time
+      over synthetic histories of each size
+
+Results are printed, and written as json with the commit they were run on so runs
+can be compared with --compare. Synthetic histories are kept in --data-dir and
+reused between runs, as the big ones take a while to make.
+
+It exits with 1 if drawing the browse screen takes longer than --startup-budget-ms.
+--startup-only checks just that, in a few seconds, to catch startup regressions.
+
+The mock server can be run by itself with --serve-mock, then used with
+OPENAI_BASE_URL=http://127.0.0.1:<port>/v1
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+words = (
+    "the a to of and in is it you that for on with as be this are or can use "
+    "git rebase branch commit python list file error function value config server "
+    "request response terminal install package version docker build test run"
+).split()
+
+sample_markdown = """# Undoing a rebase
+
+You can get back to where you were with the **reflog**, which records where
+`HEAD` has been. Find the entry from *before* the rebase started:
+
+```bash
+git reflog
+git reset --hard HEAD@{5}
+```
+
+1. Run `git reflog` and find the commit
+2. Reset to it, this throws away any uncommitted work
+   - stash first if you need to keep it
+
+| Command | What it does |
+|---------|--------------|
+| `git reflog` | Shows where HEAD has been |
+| `git reset --hard` | Moves the branch and working tree |
+
+> If the rebase is still in progress, `git rebase --abort` is simpler.
+"""
+
+
+# Mock Server ====================================================================
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """
+    Answers chat completion requests with a reply of reply_tokens words, after
+    latency seconds and then at tokens_per_sec, streamed or not.
+    """
+
+    latency = 0.3
+    tokens_per_sec = 50.0
+    reply_tokens = 200
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        tokens = ["Benchmark"] + [
+            random.choice(words) for _ in range(self.reply_tokens - 1)
+        ]
+
+        time.sleep(self.latency)
+
+        if request.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for i, token in enumerate(tokens):
+                if i > 0:
+                    time.sleep(1 / self.tokens_per_sec)
+                delta = {"content": token + ("\n\n" if i % 40 == 39 else " ")}
+                self.send_event(self.get_chunk(delta, None))
+            self.send_event(self.get_chunk({}, "stop"))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        else:
+            time.sleep(len(tokens) / self.tokens_per_sec)
+            body = json.dumps(
+                {
+                    "id": "chatcmpl-bench",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", "gpt-4o"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {
+                                "role": "assistant",
+                                "content": " ".join(tokens),
+                            },
+                            "finish_reason": "stop",
+                        }
+                    ],
+                }
+            ).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def get_chunk(self, delta, finish_reason):
+        return {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": "gpt-4o",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    def send_event(self, data):
+        self.wfile.write(b"data: " + json.dumps(data).encode("utf-8") + b"\n\n")
+        self.wfile.flush()
+
+
+def start_mock_server(latency, tokens_per_sec, reply_tokens, port=0):
+    """
+    Starts the mock server on a background thread, returning it.
+    """
+    MockHandler.latency = latency
+    MockHandler.tokens_per_sec = tokens_per_sec
+    MockHandler.reply_tokens = reply_tokens
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Helpers ========================================================================
+
+
+def get_env(data_dir, server=None):
+    env = dict(os.environ)
+    env["HEY_DATA_DIR"] = data_dir
+    env["OPENAI_API_KEY"] = "bench"
+    if server:
+        env["OPENAI_BASE_URL"] = "http://127.0.0.1:%d/v1" % server.server_port
+    return env
+
+
+def time_command(args, env, runs):
+    """
+    Returns the median wall time in ms of running the command.
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            args,
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def time_reply(args, env):
+    """
+    Runs hey and returns the ms until the reply's first token is printed,
+    and until hey exits.
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        args, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE
+    )
+    first_token = None
+    output = b""
+    while True:
+        data = os.read(process.stdout.fileno(), 4096)
+        if not data:
+            break
+        output += data
+        if first_token is None and b"Benchmark" in output:
+            first_token = (time.perf_counter() - start) * 1000
+
+    process.wait()
+    total = (time.perf_counter() - start) * 1000
+    return first_token if first_token is not None else total, total
+
+
+def time_calls(fn, runs):
+    """
+    Returns the median time in ms of calling fn.
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def get_sentence(length):
+    return " ".join(random.choice(words) for _ in range(length))
+
+
+def make_history(data_dir, size):
+    """
+    Makes a chat history db of size chats in data_dir, unless it was made before.
+    """
+    import utils
+
+    path = os.path.join(data_dir, "prev_chats.db")
+    if os.path.exists(path):
+        return
+
+    os.makedirs(data_dir, exist_ok=True)
+    use_history_db(data_dir)
+
+    random.seed(size)
+    start_time = utils.get_time_ms() - size * 60000
+    batch = []
+    for i in range(size):
+        user_time = start_time + i * 60000
+        batch.append((get_sentence(12), get_sentence(80), user_time, user_time + 5000))
+        if len(batch) == 5000:
+            utils.save_chats(batch)
+            batch = []
+    utils.save_chats(batch)
+
+
+def use_history_db(data_dir):
+    """
+    Points the in process utils module at the history in data_dir, along with its
+    vectors file and cache db.
+    """
+    import utils
+
+    for connection in [utils.db_connection, utils.cache_connection]:
+        if connection is not None:
+            connection.close()
+    utils.db_connection = None
+    utils.cache_connection = None
+    utils.segment_cache.clear()
+    utils.data_db_path = os.path.join(data_dir, "prev_chats.db")
+    utils.data_json_path = os.path.join(data_dir, "prev_chats.json")
+    utils.cache_db_path = os.path.join(data_dir, "cache.db")
+    utils.related_vectors_path = os.path.join(data_dir, "related_vectors.bin")
+    utils.get_db()
+
+
+def copy_history(data_dir):
+    """
+    Copies the history in data_dir, with its vectors file, to a new temporary dir,
+    returning the dir.
+    """
+    import utils
+
+    use_history_db(data_dir)
+    copy_dir = tempfile.mkdtemp(prefix="hey-bench-copy-")
+    copy = sqlite3.connect(os.path.join(copy_dir, "prev_chats.db"))
+    with copy:
+        utils.get_db().backup(copy)
+    copy.close()
+
+    vectors_path = os.path.join(data_dir, "related_vectors.bin")
+    if os.path.exists(vectors_path):
+        shutil.copy(vectors_path, copy_dir)
+    return copy_dir
+
+
+def unit_of(name):
+    return "/s" if name.endswith("per_sec") else "ms"
+
+
+# Benchmarks =====================================================================
+
+
+def bench_startup(data_dir, runs):
+    env = get_env(data_dir)
+    hey_path = os.path.join(script_dir, "hey.py")
+    browse = (
+        "import hey; hey.init_prev_chats(); "
+        "hey.print_prev_chats(0, hey.get_chat_index())"
+    )
+    return [
+        ("startup_help", time_command([sys.executable, hey_path, "-h"], env, runs)),
+        (
+            "startup_browse",
+            time_command(
+                [sys.executable, "-c", browse], env | {"PYTHONPATH": script_dir}, runs
+            ),
+        ),
+    ]
+
+
+def bench_reply(data_dir, server, runs):
+    env = get_env(data_dir, server)
+    hey_path = os.path.join(script_dir, "hey.py")
+    variants = (("stream", []), ("no_stream", ["--no-stream"]), ("daemon", []))
+    results = []
+    daemon = None
+
+    try:
+        for name, flags in variants:
+            if name == "daemon":
+                daemon = subprocess.Popen(
+                    [sys.executable, hey_path, "--daemon"],
+                    env=env,
+                    stdout=subprocess.DEVNULL,
+                )
+                while not os.path.exists(os.path.join(data_dir, "hey.sock")):
+                    time.sleep(0.05)
+
+            first_tokens = []
+            totals = []
+            for _ in range(runs):
+                args = [sys.executable, hey_path, "-n", "--no-cache"] + flags
+                first_token, total = time_reply(args + ["benchmark", "prompt"], env)
+                first_tokens.append(first_token)
+                totals.append(total)
+            results.append(("first_token_" + name, statistics.median(first_tokens)))
+            results.append(("inline_reply_" + name, statistics.median(totals)))
+    finally:
+        if daemon:
+            daemon.send_signal(signal.SIGINT)
+            daemon.wait()
+
+    return results
+
+
+def bench_render(runs):
+    import hey
+    from render import render_markdown
+
+    renders = 200
+    uncached = time_calls(
+        lambda: [render_markdown(sample_markdown, 80) for _ in range(renders)], runs
+    )
+
+    hey.get_markdown(sample_markdown)
+    cached = time_calls(
+        lambda: [hey.get_markdown(sample_markdown) for _ in range(renders)], runs
+    )
+    return [
+        ("render_uncached_per_sec", renders / (uncached / 1000)),
+        ("render_cached_per_sec", renders / (cached / 1000)),
+    ]
+
+
+def bench_history(data_dir, runs):
+    import hey
+    import utils
+
+    use_history_db(data_dir)
+    chats = utils.get_chat_index()
+    chat_id = chats[0]["id"]
+
+    def save():
+        utils.save_chat(get_sentence(12), get_sentence(80), 1, 2, chat_id)
+
+    screen = utils.Screen()
+
+    def redraw():
+        with redirect_stdout(io.StringIO()):
+            lines, ids = hey.get_prev_chats_lines(random.randrange(len(chats)), chats)
+            screen.draw(lines)
+
+    # Saves are made to a copy, so the history is the same for every run
+    copy_dir = copy_history(data_dir)
+    use_history_db(copy_dir)
+    save_ms = time_calls(save, runs)
+    use_history_db(data_dir)
+    shutil.rmtree(copy_dir)
+
+    return [
+        ("save_chat", save_ms),
+        ("chat_index_load", time_calls(utils.get_chat_index, runs)),
+        ("browse_redraw", time_calls(redraw, runs * 10)),
+        ("search", time_calls(lambda: utils.search_chats("git rebase"), runs)),
+    ]
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=script_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(old, new):
+    old_values = {(r["name"], r["size"]): r["value"] for r in old["results"]}
+    print("")
+    print("Compared with " + str(old.get("commit")))
+    for result in new["results"]:
+        key = (result["name"], result["size"])
+        if key not in old_values or old_values[key] == 0:
+            continue
+        change = (result["value"] - old_values[key]) / old_values[key] * 100
+        print(
+            "  %-26s %8s  %10.2f -> %10.2f %-6s %+7.1f%%"
+            % (
+                result["name"],
+                result["size"] or "",
+                old_values[key],
+                result["value"],
+                result["unit"],
+                change,
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for hey")
+    parser.add_argument("--sizes", default="100,10000,100000")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--tokens-per-sec", type=float, default=50)
+    parser.add_argument("--reply-tokens", type=int, default=200)
+    parser.add_argument(
+        "--data-dir", default=os.path.join(tempfile.gettempdir(), "hey-bench")
+    )
+    parser.add_argument("--output", help="write results as json to this file")
+    parser.add_argument("--compare", help="json results of an earlier run")
+    parser.add_argument(
+        "--startup-budget-ms",
+        type=float,
+        default=500,
+        help="fail if the browse screen takes longer than this to start",
+    )
+    parser.add_argument(
+        "--startup-only",
+        action="store_true",
+        help="only time startup, with an empty history, and check the budget",
+    )
+    parser.add_argument("--serve-mock", type=int, metavar="PORT")
+    args = parser.parse_args()
+
+    if args.serve_mock is not None:
+        server = start_mock_server(
+            args.latency_ms / 1000,
+            args.tokens_per_sec,
+            args.reply_tokens,
+            args.serve_mock,
+        )
+        print("Mock server on http://127.0.0.1:%d/v1" % server.server_port)
+        threading.Event().wait()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    # Everything in process uses a scratch data dir, never the real history
+    scratch_dir = tempfile.mkdtemp(prefix="hey-bench-")
+    os.environ["HEY_DATA_DIR"] = scratch_dir
+    sys.path.insert(0, script_dir)
+
+    server = start_mock_server(
+        args.latency_ms / 1000, args.tokens_per_sec, args.reply_tokens
+    )
+
+    results = []
+
+    def record(name, value, size=None):
+        results.append(
+            {"name": name, "size": size, "value": value, "unit": unit_of(name)}
+        )
+        print(
+            "  %-26s %8s  %10.2f %s" % (name, size or "", value, unit_of(name)),
+            flush=True,
+        )
+
+    try:
+        if args.startup_only:
+            print("Startup")
+            for name, value in bench_startup(scratch_dir, args.runs):
+                record(name, value)
+        else:
+            print("Startup, replies and rendering")
+            for name, value in bench_reply(scratch_dir, server, args.runs):
+                record(name, value)
+            for name, value in bench_render(args.runs):
+                record(name, value)
+            for name, value in bench_startup(scratch_dir, args.runs):
+                record(name, value)
+
+            print("History")
+            for size in sizes:
+                size_dir = os.path.join(args.data_dir, str(size))
+                make_history(size_dir, size)
+                for name, value in bench_startup(size_dir, args.runs):
+                    record(name, value, size)
+                for name, value in bench_history(size_dir, args.runs):
+                    record(name, value, size)
+    finally:
+        server.shutdown()
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    output = {
+        "commit": get_commit(),
+        "time": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            print_comparison(json.load(f), output)
+
+    startup = [r["value"] for r in results if r["name"] == "startup_browse"]
+    if len(startup) > 0 and startup[0] > args.startup_budget_ms:
+        print(
+            "\nBrowse startup took %.0fms, over the %.0fms budget"
+            % (startup[0], args.startup_budget_ms)
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,10 @@ def bold(str):
     return Style.BRIGHT + str + Style.RESET_ALL
 
 
+def italic(str):
+    return "\033[3m" + str + Style.RESET_ALL
+
+
 def white(str):
     return Fore.WHITE + str + Style.RESET_ALL
 
@@ -11,24 +11,36 @@ Options:
     -c, --continue	Continue the previous chat
 
 The script uses the OpenAI Python library to communicate with the GPT-4o model.
-It saves the conversation history in a JSON file named 'prev_chats.json' in the same directory as the script.
+It saves the conversation history in a SQLite db named 'prev_chats.db' in the same directory as the script.
+Chats from the older 'prev_chats.json' file are moved into the db on first run.
 
-Note: This script requires the OpenAI Python library and the 'glow' command-line tool to be installed.
+Note: This script requires the OpenAI Python library. The 'glow' command-line tool is optional,
+markdown is rendered in process unless --glow is passed.
 """
 
-from openai import OpenAI
+import timing
+from timing import timed
+import time
 import sys
+import os
 import subprocess
 import signal
 import math
+import queue
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import color as c
+from api import get_policy_texts, model, serve_daemon
+import related
+from pipe import get_piped_messages
+from transfer import run_export, run_import
+from render import render_markdown, renderer_version, rewrap, split_at_width
+import utils
 from utils import *
 import readline  # Fixes input issues
 
-# Setup OpenAI client
-client = OpenAI()
-
+timing.add_span("import", timing.start_time)
 
 # Menu Cursors
 cursor = "◉"
@@ -36,30 +48,96 @@ cursor_empty = "◦"
 
 max_page_size = 10
 
+# Print replies as they stream in, turned off with --no-stream
+stream_replies = True
+
+# Seconds replies are cached for, so repeated prompts skip the api
+# Off unless HEY_RESPONSE_CACHE_TTL is set, and skipped with --no-cache
+response_cache_ttl = int(os.environ.get("HEY_RESPONSE_CACHE_TTL", 0))
+
+# Tokens of chat history sent with each prompt, set with HEY_CONTEXT_TOKENS
+# Older messages than fit are replaced with a summary
+context_tokens = int(os.environ.get("HEY_CONTEXT_TOKENS", 16000))
+
+# Seconds to wait for a whole reply before giving up, set with HEY_REQUEST_TIMEOUT
+request_timeout = float(os.environ.get("HEY_REQUEST_TIMEOUT", 120))
+
+# Send a second request alongside a slow one and use whichever answers first,
+# turned on with HEY_HEDGE=1. The second is sent once the first has taken longer
+# than 95% of recent requests to start replying, or hedge_delay seconds until
+# enough requests have been seen to tell
+hedge_requests = os.environ.get("HEY_HEDGE") == "1"
+hedge_delay = 3
+
+# Seconds between redraws of the "..." frame while waiting for a reply
+waiting_tick = 0.3
+
+# Replies stopped by Ctrl-C or the timeout are dropped, unless HEY_KEEP_PARTIAL=1,
+# in which case the text that arrived is saved
+keep_partial_replies = os.environ.get("HEY_KEEP_PARTIAL") == "1"
+
+# Past exchanges most like the prompt sent along with it, set with HEY_RELATED_CONTEXT
+# Off by default, and needs numpy
+related_context = int(os.environ.get("HEY_RELATED_CONTEXT", 0))
+
+# Longest reply of a related exchange sent, longer ones are cut short
+max_related_chars = 2000
+
+# Whether searching matches the words of chats, or finds chats like it with --related
+search_mode = "text"
+
+# Whether the prompt is about text read from stdin, with - or --stdin
+read_stdin = False
+
+# How --batch prints replies, "jsonl" or "markdown"
+batch_format = "jsonl"
+
+# Flags followed by a value, eg: --older-than 180d
+value_flags = ["--older-than"]
+
+# Exchanges shown when a chat is reopened, /more shows this many earlier ones
+history_window = int(os.environ.get("HEY_HISTORY_EXCHANGES", 10))
+
+# Threads used to render a chat's history, set with HEY_RENDER_WORKERS
+render_workers = int(os.environ.get("HEY_RENDER_WORKERS", os.cpu_count() or 1))
+
+# Markdown is rendered in process, or by the glow command with --glow
+markdown_engine = "builtin"
+glow_style = "dark"
+
+# The last glow render of each message shown, re-wrapped when the terminal is resized
+glow_renders = {}
+
+# Redraws whatever is waiting on the user when the terminal is resized, if anything
+on_resize = None
+
 
 def signal_handler(sig, frame):
-    print(SHOW_CURSOR, end="")
+    write(SHOW_CURSOR)
+    flush_output()
     sys.exit(0)
 
 
 signal.signal(signal.SIGINT, signal_handler)
 
 
-def get_markdown(msg, no_wrap=False):
+def resize_handler(sig, frame):
+    update_terminal_size()
+    if on_resize is not None:
+        on_resize()
+
+
+signal.signal(signal.SIGWINCH, resize_handler)
+
+
+def get_glow_markdown(msg, bubble_length):
     """
-    Run a command in the shell and return the output.
+    Run glow in the shell and return the output.
     """
-    word_wrap = no_wrap == False and len(msg.strip()) > msg_width
-    bubble_length = msg_width
-    if not word_wrap:
-        bubble_length = len(msg.strip()) + 4
-    if no_wrap:
-        bubble_length = cols
-
     try:
         # Run the command
         result = subprocess.run(
-            "glow -s dark -w" + str(bubble_length),
+            "glow -s " + glow_style + " -w" + str(bubble_length),
             input=msg.strip(),
             shell=True,
             text=True,
@@ -83,56 +161,662 @@ def get_markdown(msg, no_wrap=False):
     return "\n".join(formatted).strip()
 
 
-def get_gpt_msg(prompt, prev_chat=None, no_frame=False):
+def get_bubble_length(msg, no_wrap=False):
     """
-    Generates a response from the GPT-4o model based on the prompt and previous chat history.
+    Returns the width a message is rendered at, short messages get a snug bubble.
     """
-    user_time = get_time_ms()
+    length = get_visible_length(msg.strip())
+    word_wrap = no_wrap == False and length > utils.msg_width
+    bubble_length = utils.msg_width
+    if not word_wrap:
+        bubble_length = length + 4
+    if no_wrap:
+        bubble_length = utils.cols
+
+    return bubble_length
+
+
+def get_render_style():
+    """
+    Returns the style renders are cached under, changing with the engine and its version.
+    """
+    if markdown_engine == "glow":
+        return "glow-" + glow_style
+    return "builtin-" + str(renderer_version)
+
+
+def render_uncached(msg, bubble_length):
+    """
+    Renders a message's markdown with the selected engine, skipping the cache.
+    """
+    if markdown_engine == "glow":
+        return get_glow_markdown(msg, bubble_length)
+
+    # Glow keeps a margin of 2 on each side, so the text is wrapped to match
+    return render_markdown(msg.strip(), bubble_length - 4)
+
+
+@timed("get_markdown")
+def get_markdown(msg, no_wrap=False):
+    """
+    Renders a message's markdown for the terminal, with glow if --glow was passed.
+    Renders are cached, so messages that were shown before are not rendered again.
+    """
+    bubble_length = get_bubble_length(msg, no_wrap)
+    key = get_render_key(msg.strip(), bubble_length, get_render_style())
+    output = get_cached_render(key)
+    if output is None:
+        output = render_uncached(msg, bubble_length)
+        save_cached_render(key, output)
+
+    if markdown_engine == "glow":
+        glow_renders[msg.strip()] = output
+    return output
+
+
+@timed("get_markdowns")
+def get_markdowns(msgs, no_wrap=False, reflow=False):
+    """
+    Renders many messages at once, returning them in order. Messages that are not
+    cached are rendered concurrently, over up to render_workers threads.
+    With reflow, glow renders shown before the terminal was resized are re-wrapped
+    to the new width rather than running glow again.
+    """
+    uncached = []
+    style = get_render_style()
+
+    # The cache is only touched from this thread, as its connection can't be shared
+    bubble_lengths = [get_bubble_length(msg, no_wrap) for msg in msgs]
+    keys = [
+        get_render_key(msg.strip(), bubble_length, style)
+        for msg, bubble_length in zip(msgs, bubble_lengths)
+    ]
+    outputs = get_cached_renders(keys)
+
+    for i, (msg, key, bubble_length) in enumerate(zip(msgs, keys, bubble_lengths)):
+        if outputs[i] is None and reflow and msg.strip() in glow_renders:
+            # Glow leaves a margin of 2, which get_glow_markdown takes off the left
+            outputs[i] = rewrap(glow_renders[msg.strip()], bubble_length - 2)
+        elif outputs[i] is None:
+            uncached.append((i, key, msg, bubble_length))
+        elif markdown_engine == "glow":
+            glow_renders[msg.strip()] = outputs[i]
+
+    if len(uncached) > 0:
+        with ThreadPoolExecutor(max_workers=max(1, render_workers)) as pool:
+            rendered = pool.map(
+                lambda item: render_uncached(item[2], item[3]), uncached
+            )
+            renders = []
+            for (i, key, msg, bubble_length), output in zip(uncached, rendered):
+                renders.append((key, output))
+                outputs[i] = output
+                if markdown_engine == "glow":
+                    glow_renders[msg.strip()] = output
+        save_cached_renders(renders)
+
+    return outputs
+
+
+def split_markdown_blocks(text):
+    """
+    Splits the finished paragraphs and code blocks off the front of streamed text.
+    Returns the list of finished blocks and the unfinished remainder.
+    """
+    blocks = []
+    block = []
+    in_code = False
+    consumed = 0
+    pos = 0
+
+    # The last line may still be streaming in, so only look at complete lines
+    for line in text.split("\n")[:-1]:
+        pos += len(line) + 1
+        if line.strip().startswith("```"):
+            in_code = not in_code
+
+        if line.strip() == "" and not in_code:
+            if len(block) > 0:
+                blocks.append("\n".join(block))
+                block = []
+            consumed = pos
+        else:
+            block.append(line)
+
+    return blocks, text[consumed:]
+
 
+def clear_raw_text(text):
+    """
+    Clears the unformatted text printed while streaming, accounting for line wrapping.
+    """
+    rows = 0
+    for line in text.split("\n"):
+        rows += max(1, math.ceil(get_visible_length(line) / utils.cols))
+
+    write("\r" + CLEAR_RIGHT)
+    clear_n_lines(rows - 1)
+
+
+def print_waiting_frame(no_frame=False):
+    """
+    Prints the "..." frame shown while waiting for a reply. Like its animation, it's
+    only shown on a terminal, so output redirected to a file doesn't collect it.
+    """
+    if not sys.stdout.isatty():
+        return
+    write(HIDE_CURSOR)
     if no_frame == False:
-        print(HIDE_CURSOR, end="")
         print_ai_msg(c.yellow("\n   ...\n"), get_time_ms(), ignore_markdown=True)
         fake_user_input()
     else:
-        print(HIDE_CURSOR, end="")
-        print(c.yellow("\n   ...\n"))
+        write_line(c.yellow("\n   ...\n"))
+    flush_output()
 
-    messages = [{"role": "user", "content": prompt}]
 
-    if prev_chat:
-        oai_format_prev = []
-        for msg in prev_chat["messages"]:
-            oai_format_prev.append({"role": msg["role"], "content": msg["content"]})
-        messages = oai_format_prev + messages
-
-    completion = client.chat.completions.create(model="gpt-4o", messages=messages)
+def animate_waiting_frame(tick, no_frame=False):
+    """
+    Redraws the dots of the "..." frame, which are a few lines above the cursor.
+    """
+    if not sys.stdout.isatty():
+        return
+    lines_up = 2 if no_frame else 5
+    dots = c.yellow("   " + "." * (tick % 3 + 1))
+    write(f"\033[{lines_up}F{CLEAR_RIGHT}{dots}\033[{lines_up}E")
+    flush_output()
 
-    ai_time = get_time_ms()
-    msg = completion.choices[0].message.content
-    if prev_chat:
-        save_chat(prompt, msg, user_time, ai_time, prev_chat["id"])
-    else:
-        save_chat(prompt, msg, user_time, ai_time)
 
+def clear_waiting_frame(no_frame=False):
+    """
+    Clears the "..." frame shown while waiting for a reply.
+    """
+    if not sys.stdout.isatty():
+        return
     if no_frame == False:
         clear_n_lines(8)
     else:
         clear_n_lines(2)
-    print(SHOW_CURSOR, end="")
+
+
+class ReplyStopped(Exception):
+    """
+    Waiting for a reply was stopped by Ctrl-C, the timeout or a failed request, with
+    the text that had arrived by then.
+    """
+
+    def __init__(self, reason, partial_reply=""):
+        super().__init__(reason)
+        self.partial_reply = partial_reply
+
+
+def get_stop_reason(e):
+    if isinstance(e, KeyboardInterrupt):
+        return "Cancelled"
+    if isinstance(e, TimeoutError):
+        return str(e)
+    return "Request failed: " + str(e)
+
+
+def wait_for_reply(texts, no_frame=False):
+    """
+    Waits for a whole reply, animating the "..." frame meanwhile. Returns the reply.
+    """
+    msg = ""
+    tick = 0
+    try:
+        for text in texts:
+            if text is None:
+                tick += 1
+                animate_waiting_frame(tick, no_frame)
+            else:
+                msg += text
+    except (KeyboardInterrupt, Exception) as e:
+        clear_waiting_frame(no_frame)
+        raise ReplyStopped(get_stop_reason(e), msg)
+
+    clear_waiting_frame(no_frame)
+    return msg
+
+
+def print_ai_msg_stream(texts, time, no_frame=False):
+    """
+    Prints a reply as it streams in. Text is shown raw as it arrives, then each
+    finished paragraph or code block is redrawn as markdown. Returns the full reply.
+    Until the first text arrives the "..." frame is animated.
+    When stdout isn't a terminal the raw text can't be cleared, so only the markdown
+    is printed.
+    """
+    echo_raw = sys.stdout.isatty()
+    msg = ""
+    pending = ""
+    is_first_text = True
+    is_first_block = True
+    tick = 0
+
+    try:
+        for text in texts:
+            if text is None:
+                if is_first_text:
+                    tick += 1
+                    animate_waiting_frame(tick, no_frame)
+                continue
+
+            if is_first_text:
+                clear_waiting_frame(no_frame)
+                if no_frame == False:
+                    print_ai_msg_header(time)
+                is_first_text = False
+
+            msg += text
+            pending += text
+            if echo_raw:
+                write(text)
+                flush_output()
+
+            blocks, rest = split_markdown_blocks(pending)
+            if len(blocks) > 0:
+                if echo_raw:
+                    clear_raw_text(pending)
+                for block in blocks:
+                    if not is_first_block:
+                        write_line("")
+                    write_line(get_markdown(block, no_wrap=no_frame))
+                    is_first_block = False
+
+                pending = rest
+                if echo_raw:
+                    write(pending)
+                flush_output()
+
+    except (KeyboardInterrupt, Exception) as e:
+        # Tidy up what was shown, then leave it on screen above the note
+        if is_first_text:
+            clear_waiting_frame(no_frame)
+        elif len(pending.strip()) > 0:
+            if echo_raw:
+                clear_raw_text(pending)
+            write_line(get_markdown(pending, no_wrap=no_frame))
+        raise ReplyStopped(get_stop_reason(e), msg)
+
+    if is_first_text:
+        clear_waiting_frame(no_frame)
+
+    if len(pending.strip()) > 0:
+        if echo_raw:
+            clear_raw_text(pending)
+        if not is_first_block:
+            write_line("")
+        write_line(get_markdown(pending, no_wrap=no_frame))
 
     return msg
 
 
+def summarise_messages(summary, messages):
+    """
+    Rolls messages into the summary of a chat, returning the new summary.
+    """
+    # At about 4 characters a token, a message longer than half the budget is cut
+    # short so the request still fits
+    max_chars = context_tokens * 2
+    transcript = "\n\n".join(
+        msg["role"] + ": " + msg["content"][:max_chars] for msg in messages
+    )
+    if summary:
+        transcript = "Summary so far: " + summary + "\n\n" + transcript
+
+    texts = get_policy_texts(
+        [
+            {
+                "role": "system",
+                "content": "Summarise this conversation between a user and an assistant. "
+                + "Keep any facts, decisions, code and names needed to carry it on.",
+            },
+            {"role": "user", "content": transcript},
+        ],
+        deadline=time.monotonic() + request_timeout,
+    )
+    return "".join(texts)
+
+
+def get_related_messages(prompt, prev_chat=None):
+    """
+    Returns a system message with the past exchanges from other chats most like
+    the prompt, or nothing if there are none.
+    """
+    exchanges = get_related_exchanges(
+        prompt, related_context, prev_chat["id"] if prev_chat else None
+    )
+    if len(exchanges) == 0:
+        return []
+
+    parts = []
+    for question, answer in exchanges:
+        parts.append(
+            "Q: "
+            + question["content"]
+            + "\nA: "
+            + answer["content"][:max_related_chars]
+        )
+    return [
+        {
+            "role": "system",
+            "content": "Answers from earlier chats that may be relevant:\n\n"
+            + "\n\n".join(parts),
+        }
+    ]
+
+
+@timed("get_context_messages")
+def get_context_messages(prompt, prev_chat=None):
+    """
+    Returns the messages to send for a prompt. The most recent messages are sent as
+    is, up to context_tokens, with the ones before them replaced by a saved summary.
+    If the summary can't be updated, the messages not in it yet are left out.
+    """
+    messages = [{"role": "user", "content": prompt}]
+    if not prev_chat:
+        if related_context > 0:
+            return get_related_messages(prompt) + messages
+        return messages
+
+    history = prev_chat["messages"]
+    summary_count, summary = get_chat_summary(prev_chat["id"])
+
+    tokens = count_tokens(prompt) + count_tokens(summary)
+    for msg in history[summary_count:]:
+        tokens += count_tokens(msg["content"])
+
+    if tokens > context_tokens:
+        # Keep only half the budget verbatim, so the summary lasts a few turns
+        # before it needs updating again
+        kept_tokens = count_tokens(prompt)
+        cut = len(history)
+        while cut > summary_count:
+            msg_tokens = count_tokens(history[cut - 1]["content"])
+            if kept_tokens + msg_tokens > context_tokens / 2:
+                break
+            kept_tokens += msg_tokens
+            cut -= 1
+
+        # Cut between exchanges, not partway through one
+        if cut % 2 == 1:
+            cut += 1
+
+        # Rolled into the summary a piece at a time, so each request fits in the
+        # budget however long the chat got before it was summarised
+        try:
+            while cut > summary_count:
+                end = summary_count + 1
+                piece_tokens = count_tokens(summary) + count_tokens(
+                    history[summary_count]["content"]
+                )
+                while end < cut:
+                    msg_tokens = count_tokens(history[end]["content"])
+                    if piece_tokens + msg_tokens > context_tokens / 2:
+                        break
+                    piece_tokens += msg_tokens
+                    end += 1
+
+                summary = summarise_messages(summary, history[summary_count:end])
+                summary_count = end
+                save_chat_summary(prev_chat["id"], summary_count, summary)
+        except Exception:
+            # The rest are left out of this request, and summarised with the next one
+            summary_count = cut
+
+    oai_format_prev = []
+    if related_context > 0:
+        oai_format_prev += get_related_messages(prompt, prev_chat)
+    if summary:
+        oai_format_prev.append(
+            {
+                "role": "system",
+                "content": "Summary of the earlier conversation: " + summary,
+            }
+        )
+    for msg in history[summary_count:]:
+        oai_format_prev.append({"role": msg["role"], "content": msg["content"]})
+
+    return oai_format_prev + messages
+
+
+def get_hedge_delay():
+    """
+    Returns the seconds to wait before hedging a request, or None if hedging is off.
+    """
+    if not hedge_requests:
+        return None
+    p95 = get_request_latency_percentile(95)
+    return hedge_delay if p95 is None else p95 / 1000
+
+
+def get_background_texts(messages, attempts=None):
+    """
+    Requests a reply in a background thread, yielding its text as it arrives, and None
+    every waiting_tick seconds in between so the caller can animate or be interrupted.
+    Raises TimeoutError if the reply hasn't finished within request_timeout seconds.
+    Each attempt at the request is recorded in attempts, see get_policy_texts.
+    """
+    pieces = queue.Queue()
+    cancelled = threading.Event()
+    deadline = time.monotonic() + request_timeout
+    delay = get_hedge_delay()
+
+    def request():
+        try:
+            for text in get_policy_texts(
+                messages, stream_replies, deadline, delay, attempts
+            ):
+                if cancelled.is_set():
+                    return
+                pieces.put(("text", text))
+            pieces.put(("done", None))
+        except Exception as e:
+            pieces.put(("error", e))
+
+    threading.Thread(target=request, daemon=True).start()
+
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("No reply within %g seconds" % request_timeout)
+
+            try:
+                kind, value = pieces.get(timeout=min(waiting_tick, remaining))
+            except queue.Empty:
+                yield None
+                continue
+
+            if kind == "done":
+                return
+            if kind == "error":
+                raise value
+            yield value
+    finally:
+        # Stops the request thread at its next piece if the reply was abandoned
+        cancelled.set()
+
+
+def get_reply_texts(messages, attempts=None):
+    """
+    Requests a reply to the messages, yielding its text as it arrives when streaming,
+    or all at once when not, and None while waiting (see get_background_texts).
+    Replies are taken from the response cache if it is on.
+    """
+    use_cache = response_cache_ttl > 0
+    if use_cache:
+        key = get_response_key(model, messages)
+        reply = get_cached_response(key, response_cache_ttl)
+        if reply is not None:
+            yield reply
+            return
+
+    # When streaming, api_request also includes printing each piece as it arrives
+    start = time.perf_counter()
+    reply = ""
+    first_token_ms = None
+    for text in get_background_texts(messages, attempts):
+        if text is None:
+            yield None
+            continue
+        if reply == "":
+            timing.add_span("api_first_token", start)
+            first_token_ms = (time.perf_counter() - start) * 1000
+        reply += text
+        yield text
+    timing.add_span("api_request", start)
+
+    # Replies that aren't streamed only arrive once finished, which isn't a first token
+    if first_token_ms is not None and stream_replies:
+        save_request_latency(first_token_ms)
+
+    if use_cache:
+        save_cached_response(key, reply, response_cache_ttl)
+
+
+def get_reply_meta(attempts):
+    """
+    Returns the metadata saved with a reply, or None if no request was made (eg: it
+    was cached).
+    """
+    return {"attempts": attempts} if len(attempts) > 0 else None
+
+
+def get_gpt_msg(prompt, prev_chat=None, no_frame=False, messages=None):
+    """
+    Generates a response from the GPT-4o model based on the prompt and previous chat history.
+    If messages are given they're sent instead, and saved as just the prompt.
+    When streaming, the reply is printed as it arrives.
+    Ctrl-C, the timeout or a failed request stops only this request, and None is returned.
+    The reply is saved with a record of the attempts made at the request.
+    """
+    user_time = get_time_ms()
+    attempts = []
+    print_waiting_frame(no_frame)
+
+    # Ctrl-C interrupts the request rather than quitting while waiting for it
+    previous_handler = signal.signal(signal.SIGINT, signal.default_int_handler)
+    try:
+        try:
+            if messages is None:
+                messages = get_context_messages(prompt, prev_chat)
+        except KeyboardInterrupt:
+            clear_waiting_frame(no_frame)
+            raise ReplyStopped("Cancelled")
+
+        if stream_replies:
+            msg = print_ai_msg_stream(
+                get_reply_texts(messages, attempts), get_time_ms(), no_frame=no_frame
+            )
+        else:
+            msg = wait_for_reply(get_reply_texts(messages, attempts), no_frame)
+    except ReplyStopped as e:
+        msg = None
+        if no_frame:
+            write_line(c.grey(str(e)))
+        else:
+            # The line after is cleared along with the next input
+            write_line(c.grey("   " + str(e)))
+            write_line("")
+        if keep_partial_replies and len(e.partial_reply.strip()) > 0:
+            partial = e.partial_reply + "\n\n*(reply cut short)*"
+            save_chat(
+                prompt,
+                partial,
+                user_time,
+                get_time_ms(),
+                (prev_chat or {}).get("id"),
+                get_reply_meta(attempts),
+            )
+    finally:
+        signal.signal(signal.SIGINT, previous_handler)
+
+    if msg is not None:
+        ai_time = get_time_ms()
+        meta = get_reply_meta(attempts)
+        if prev_chat:
+            save_chat(prompt, msg, user_time, ai_time, prev_chat["id"], meta)
+        else:
+            save_chat(prompt, msg, user_time, ai_time, meta=meta)
+
+    if sys.stdout.isatty():
+        write(SHOW_CURSOR)
+    flush_output()
+
+    return msg
+
+
+def reply_to_piped(prompt):
+    """
+    Replies to the prompt about the text from stdin, answering it about each
+    chunk of the text first if there's too much to send at once.
+    """
+    write_line("")
+    flush_output()
+    try:
+        messages = get_piped_messages(prompt, sys.stdin, request_timeout)
+    except Exception as e:
+        write_line(c.grey(get_stop_reason(e)))
+        return
+
+    msg = get_gpt_msg(prompt, None, no_frame=True, messages=messages)
+    if msg is not None and not stream_replies:
+        write_line(get_markdown(msg, no_wrap=True))
+
+
+def prune_history(older_than):
+    """
+    Deletes the chats older than the given age, or all of them, and exits.
+    """
+    if older_than is None:
+        count = prune_chats()
+    else:
+        age = parse_age_ms(older_than)
+        if age is None:
+            write_line(
+                "Couldn't read the age " + older_than + ", try something like 180d"
+            )
+            flush_output()
+            sys.exit(1)
+        count = prune_chats(get_time_ms() - age)
+
+    write_line("Removed " + str(count) + (" chat" if count == 1 else " chats"))
+    flush_output()
+    sys.exit(0)
+
+
 def get_args():
     """
     Parses the command-line arguments and returns the prompt and is_continue flag.
     """
+    global stream_replies, markdown_engine, response_cache_ttl, batch_format, search_mode
+    global read_stdin
     args = sys.argv
+
+    # Take out the values of flags that have one, so they aren't part of the prompt
+    flag_values = {}
+    for i, arg in enumerate(args):
+        if arg not in value_flags:
+            continue
+        if i + 1 == len(args) or args[i + 1].startswith("-"):
+            write_line(arg + " needs a value, like " + arg + " 180d")
+            flush_output()
+            sys.exit(1)
+        flag_values[arg] = args[i + 1]
+    args = [
+        arg for i, arg in enumerate(args) if i == 0 or args[i - 1] not in value_flags
+    ]
+
     arg_flags = [arg for arg in args if arg[0] == "-"]
     prompt = " ".join([arg for arg in args[1:] if arg[0] != "-"])
     is_continue = False
     is_new = False
     is_interactive = False
+    is_search = False
+    is_batch = False
+    is_export = False
+    is_import = False
 
     for arg_flag in arg_flags:
         if arg_flag == "-c" or arg_flag == "--continue":
@@ -141,30 +825,105 @@ def get_args():
             is_new = True
         elif arg_flag == "-i" or arg_flag == "--interactive":
             is_interactive = True
-        elif arg_flag == "--clear-history":
-            reset_prev_chats()
+        elif arg_flag == "-s" or arg_flag == "--search":
+            is_search = True
+        elif arg_flag == "--related":
+            is_search = True
+            search_mode = "related"
+        elif arg_flag == "--batch":
+            is_batch = True
+        elif arg_flag == "--export":
+            is_export = True
+        elif arg_flag == "--import":
+            is_import = True
+        elif arg_flag == "-" or arg_flag == "--stdin":
+            read_stdin = True
+        elif arg_flag == "--markdown":
+            batch_format = "markdown"
+        elif arg_flag == "--prune" or arg_flag == "--clear-history":
+            prune_history(flag_values.get("--older-than"))
+        elif arg_flag in value_flags:
+            pass
+        elif arg_flag == "--no-stream":
+            stream_replies = False
+        elif arg_flag == "--glow":
+            markdown_engine = "glow"
+        elif arg_flag == "--no-cache":
+            response_cache_ttl = 0
+        elif arg_flag == "--profile":
+            timing.enable()
+        elif arg_flag == "--daemon":
+            write_line("hey daemon listening, Ctrl-C to stop")
+            flush_output()
+            serve_daemon()
+            sys.exit(0)
+        elif arg_flag == "--cache-stats":
+            hits, misses, cached = get_response_cache_stats()
+            write_line("Response cache hits:    " + str(hits))
+            write_line("Response cache misses:  " + str(misses))
+            write_line("Cached responses:       " + str(cached))
+            flush_output()
+            sys.exit(0)
         else:
-            print("")
+            write_line("")
             print_header()
-            print(
+            write_line(
                 "Passing no prompt opens in interactive mode, passing a prompt will make it reply in 'inine' mode."
             )
-            print("")
-            print(
+            write_line("")
+            write_line(
                 "If the previous chat was less than 5 mins ago, it will by default continue."
             )
-            print("")
-            print("")
-            print("Usage: hey [OPTIONS -optional] [PROMPT -optional]")
-            print("")
-            print("Options:")
-            print("  -n, --new          Jumps straight into a new conversation")
-            print("  -c, --continue     Continue the previous chat")
-            print("  -i, --interactive  Reply to prompt in interactive chat")
-            print("  --clear-history    Removes all previous chats")
+            write_line("")
+            write_line("")
+            write_line("Usage: hey [OPTIONS -optional] [PROMPT -optional]")
+            write_line("")
+            write_line("Options:")
+            write_line("  -n, --new          Jumps straight into a new conversation")
+            write_line("  -c, --continue     Continue the previous chat")
+            write_line("  -i, --interactive  Reply to prompt in interactive chat")
+            write_line("  -s, --search       Search previous chats for the prompt")
+            write_line("  --related          Browse the chats most like the prompt")
+            write_line(
+                "  --batch [FILE]     Reply to each line of the file, or stdin, as jsonl"
+            )
+            write_line(
+                "  --export [FILE]    Writes all chats to the file, or stdout, as jsonl"
+            )
+            write_line(
+                "  --import [FILE]    Adds the chats in the file, or stdin, to your chats"
+            )
+            write_line(
+                "  -, --stdin         Ask the prompt about text from stdin (eg: cat app.log | hey - what failed)"
+            )
+            write_line(
+                "  --markdown         Print --batch replies or --export as markdown instead"
+            )
+            write_line(
+                "  --no-stream        Wait for the full reply before printing it"
+            )
+            write_line("  --glow             Render markdown with glow instead")
+            write_line("  --no-cache         Skip the response cache for this prompt")
+            write_line("  --cache-stats      Shows response cache hits and misses")
+            write_line(
+                "  --daemon           Keeps a warm api connection for other runs to use"
+            )
+            write_line("  --profile          Prints how long each phase took on exit")
+            write_line("  --prune            Removes all previous chats, or with")
+            write_line("  --older-than AGE   only those older than AGE (eg: 180d)")
+            flush_output()
             sys.exit(0)
 
-    return prompt, is_continue, is_new, is_interactive
+    return (
+        prompt,
+        is_continue,
+        is_new,
+        is_interactive,
+        is_search,
+        is_batch,
+        is_export,
+        is_import,
+    )
 
 
 def print_ai_msg(msg, time, ignore_markdown=False):
@@ -181,19 +940,27 @@ def print_user_msg(msg, time):
     print_user_msg_frame(md, time)
 
 
-def print_header():
-    print(c.bold(c.purple_bg(" hey ")))
-    print(c.grey("Your personal terminal assistant"))
-    print("")
+def get_header_lines():
+    return [
+        c.bold(c.purple_bg(" hey ")),
+        c.grey("Your personal terminal assistant"),
+        "",
+    ]
+
 
+def print_header():
+    for line in get_header_lines():
+        write_line(line)
 
-def print_prev_chats(position):
 
-    print_header()
+def get_prev_chats_lines(position, chats, empty_msg="No previous chats found."):
+    """
+    Returns the lines of the browse menu showing the page of the chat index holding
+    the selected position, and the ids of the chats on that page.
+    """
     global browse_page_size
+    lines = get_header_lines()
 
-    # Read the original data
-    chats = get_saved_chats()
     num_pages = 0
     selected_page = math.floor(position / max_page_size)
     selected = position - (selected_page * max_page_size)
@@ -201,8 +968,8 @@ def print_prev_chats(position):
 
     # if no prev chats, show msg
     if len(chats) == 0:
-        margin = math.floor((cols - 24) / 2) * " "
-        print(margin + c.grey("No previous chats found.") + margin)
+        margin = math.floor((utils.cols - len(empty_msg)) / 2) * " "
+        lines.append(margin + c.grey(empty_msg) + margin)
         browse_page_size = 1
 
     else:
@@ -215,21 +982,26 @@ def print_prev_chats(position):
 
         index = 1
         ids = []
-        max_preview = cols - 35
+        max_preview = utils.cols - 35
         for chat in chat_page:
-            msgs = chat["messages"]
             active = selected == index - 1
 
-            date = get_formatted_datetime(msgs[0]["time"]) + "  "
-            preview = msgs[0]["content"][0:max_preview].replace("\n", "")
-            is_trunc = len(preview) < len(msgs[0]["content"])
+            date = get_formatted_datetime(chat["first_time"]) + "  "
+            preview, rest = split_at_width(
+                chat["preview"].replace("\n", ""), max_preview
+            )
+            is_trunc = len(rest) > 0
             preview_trail = ("..." if is_trunc else "   ") + " " * (
-                max_preview - len(preview)
+                max_preview - get_visible_length(preview)
+            )
+            msg_count = (
+                " (" + str(chat["message_count"]) + ")"
+                if chat["message_count"] > 2
+                else ""
             )
-            msg_count = " (" + str(len(msgs)) + ")" if len(msgs) > 2 else ""
 
             if active:
-                print(
+                lines.append(
                     c.green(cursor + " ")
                     + c.bold(c.grey(date))
                     + c.bold(preview)
@@ -237,7 +1009,7 @@ def print_prev_chats(position):
                     + c.bold(c.grey(msg_count))
                 )
             else:
-                print(
+                lines.append(
                     c.grey(cursor_empty + " ")
                     + c.grey(date)
                     + preview
@@ -249,7 +1021,7 @@ def print_prev_chats(position):
             index += 1
 
         for _ in range(browse_page_size - len(chat_page)):
-            print("")
+            lines.append("")
 
         if num_pages > 1:
             pages = []
@@ -260,35 +1032,73 @@ def print_prev_chats(position):
                     pages.append(str(page))
 
             page_bar = "[ " + " ".join(pages) + " ]"
-            print("\n" + center(c.grey(page_bar)))
+            lines.append("")
+            lines.append(center(c.grey(page_bar)))
 
-    padding = round((cols - 18) / 3) * " "
-    print(c.purple("\n" + padding + "(n)ew chat" + padding + "(q)uit\n"))
+    padding = round((utils.cols - 26) / 4) * " "
+    lines.append("")
+    lines.append(
+        c.purple(padding + "(n)ew chat" + padding + "(/) search" + padding + "(q)uit")
+    )
+    lines.append("")
+
+    return lines, ids
+
+
+def print_prev_chats(position, chats, empty_msg="No previous chats found."):
+    """
+    Prints the page of the chat index holding the selected position.
+    """
+    lines, ids = get_prev_chats_lines(position, chats, empty_msg)
+    for line in lines:
+        write_line(line)
 
     return ids
 
 
-def browse_interface():
+def get_browse_chats(search=""):
     """
-    Prompt interface, printing previous
+    Returns the chats to list in the browse menu, and the message shown if there are none.
     """
-    global browse_page_size
+    if search.strip() == "":
+        return get_chat_index(), "No previous chats found."
+    if search_mode == "related":
+        if not related.get_numpy():
+            return [], "Finding related chats needs numpy (pip install numpy)."
+        return get_related_chats(search), "No chats like '" + search.strip() + "'."
+    return search_chats(search), "No chats found for '" + search.strip() + "'."
+
+
+def browse_interface(search=""):
+    """
+    Prompt interface, printing previous chats, or those matching the search
+    """
+    global browse_page_size, on_resize
     new_chat = False
     position = 0
     choice = 0
-    total_chats = len(get_saved_chats())
+    # Loaded once, paging is done in memory
+    chats, empty_msg = get_browse_chats(search)
+    total_chats = len(chats)
 
-    print(HIDE_CURSOR)
-    ids = print_prev_chats(position)
+    # Keypresses only redraw the lines of the menu that changed
+    screen = Screen()
 
-    has_chat_pages = total_chats > max_page_size
-    ui_size = 7
-    if has_chat_pages:
-        ui_size += 1
+    write_line(HIDE_CURSOR)
+    lines, ids = get_prev_chats_lines(position, chats, empty_msg)
+    screen.draw(lines)
+
+    def redraw_menu():
+        # The terminal may have moved the menu's lines about, so start again
+        screen.redraw(get_prev_chats_lines(position, chats, empty_msg)[0])
 
     while True:
         num_options = len(ids)
-        key = get_key()
+        on_resize = redraw_menu
+        try:
+            key = get_key()
+        finally:
+            on_resize = None
 
         if key == "\x1b":  # Handle escape sequences
             key += get_key()
@@ -299,93 +1109,158 @@ def browse_interface():
             position -= 1
             if position < 0:
                 position = total_chats - 1
-            clear_n_lines(num_options + ui_size)
-            ids = print_prev_chats(position)
 
         # Down arrow
         elif key == "\x1b[B":
             position += 1
             if position >= total_chats:
                 position = 0
-            clear_n_lines(num_options + ui_size)
-            ids = print_prev_chats(position)
 
         # Tab or Arrow Right
         elif key == "\t" or key == "\x1b[C":
             position += browse_page_size - (position % max_page_size)
             if position >= total_chats:
                 position = 0
-            clear_n_lines(num_options + ui_size)
-            ids = print_prev_chats(position)
 
         # Arrow Left
         elif key == "\x1b[D":
             position -= (position % max_page_size) + browse_page_size
             if position < 0:
                 position = total_chats - 1
-            clear_n_lines(num_options + ui_size)
-            ids = print_prev_chats(position)
 
         # Select Option
-        elif key == "\n" or key == "\r":
-            clear_n_lines(num_options + ui_size)
+        elif (key == "\n" or key == "\r") and num_options > 0:
+            screen.clear()
             choice = position % num_options
             break
 
         # Quit with 'q'
         elif key == "q" or key == "\x1b":
-            clear_n_lines(max(1, num_options) + ui_size + 1)
-            print(SHOW_CURSOR)
+            screen.clear()
+            clear_n_lines(1)
+            write_line(SHOW_CURSOR)
             return
 
+        # Search with '/'
+        elif key == "/":
+            screen.clear()
+            write(SHOW_CURSOR)
+            flush_output()
+            search = input(c.purple("/ "))
+            clear_n_lines(1)
+            write(HIDE_CURSOR)
+
+            chats, empty_msg = get_browse_chats(search)
+            total_chats = len(chats)
+            position = 0
+
         # new chat with 'n
         elif key == "n":
-            clear_n_lines(num_options + ui_size)
+            screen.clear()
             new_chat = True
             break
 
-    print(SHOW_CURSOR)
+        else:
+            continue
+
+        lines, ids = get_prev_chats_lines(position, chats, empty_msg)
+        screen.draw(lines)
+
+    write_line(SHOW_CURSOR)
     if new_chat:
         chat_interface(is_new=True)
     else:
         chat_interface(chat_id=ids[choice])
 
 
+def print_chat_header(prev_chat):
+    if prev_chat is None:
+        centre = " New Chat "
+    else:
+        centre = (
+            " Chat from " + get_formatted_date(prev_chat["messages"][-1]["time"]) + " "
+        )
+
+    bar = " " * math.floor((utils.cols - len(centre)) / 2)
+
+    write_line(c.grey(bar + centre + bar))
+
+
+def print_chat_history(messages, first_shown, reflow=False):
+    """
+    Prints a chat's messages from first_shown on, with a note of how many earlier
+    ones are hidden. Only the shown messages are rendered.
+    """
+    if first_shown > 0:
+        hidden = str(first_shown) + (
+            " earlier message" if first_shown == 1 else " earlier messages"
+        )
+        write_line("")
+        write_line(c.grey(center(hidden + ", /more shows them")))
+
+    # Render the shown messages together, then print them in order
+    messages = messages[first_shown:]
+    rendered = get_markdowns([msg["content"] for msg in messages], reflow=reflow)
+    for msg, md in zip(messages, rendered):
+        if msg["role"] == "user":
+            print_user_msg_frame(md, msg["time"])
+        if msg["role"] == "assistant":
+            print_ai_msg_frame(md, msg["time"])
+
+
 def chat_interface(prompt="", chat_id=None, is_new=False):
     """
     Provides an interactive interface for continuing the chat with the GPT-4o model.
     """
-    global browse_page_size
+    global browse_page_size, on_resize
     prev_chat = get_prev_chat(chat_id) if not is_new else None
     has_quit = False
 
-    if is_new:
-        centre = " New Chat "
-    else:
-        centre = (
-            " Chat from " + get_formatted_date(prev_chat["messages"][-1]["time"]) + " "
-        )
+    # The chat's messages, along with those sent since it was opened
+    messages = list(prev_chat["messages"]) if prev_chat else []
 
-    bar = " " * math.floor((cols - len(centre)) / 2)
+    # Only the last few exchanges are shown to start with
+    first_shown = max(len(messages) - history_window * 2, 0)
 
-    print(c.grey(bar + centre + bar))
+    def redraw_chat(reflow=False):
+        write(CLEAR_SCREEN)
+        print_chat_header(prev_chat)
+        print_chat_history(messages, first_shown, reflow)
 
-    if not is_new:
-        # Print the previous messages
-        for msg in prev_chat["messages"]:
-            if msg["role"] == "user":
-                print_user_msg(msg["content"], msg["time"])
-            if msg["role"] == "assistant":
-                print_ai_msg(msg["content"], msg["time"])
+    def redraw_input():
+        # Resizing while typing redraws the chat at the new width, then the input
+        redraw_chat(reflow=True)
+        print_input_frame(readline.get_line_buffer())
 
-    if len(prompt) > 0:
-        print_user_msg(prompt, get_time_ms())
+    def send(prompt):
+        user_time = get_time_ms()
+        print_user_msg(prompt, user_time)
 
         msg = get_gpt_msg(prompt, prev_chat)
-        print_ai_msg(msg, get_time_ms())
+        if msg is None:
+            return
+
+        ai_time = get_time_ms()
+        if not stream_replies:
+            print_ai_msg(msg, ai_time)
+        messages.append({"role": "user", "content": prompt, "time": user_time})
+        messages.append({"role": "assistant", "content": msg, "time": ai_time})
+
+    print_chat_header(prev_chat)
+    print_chat_history(messages, first_shown)
+
+    # The whole history goes out in one write
+    flush_output()
+
+    if len(prompt) > 0:
+        send(prompt)
 
     while not has_quit:
-        prompt = user_input()
+        on_resize = redraw_input
+        try:
+            prompt = user_input()
+        finally:
+            on_resize = None
 
         # To stop me entering empty inputs
         if len(prompt.strip()) < 1:
@@ -397,11 +1272,19 @@ def chat_interface(prompt="", chat_id=None, is_new=False):
             print_goodbye()
             continue
 
-        clear_n_lines(1)
-        print_user_msg(prompt, get_time_ms())
+        if prompt.strip() == "/more":
+            clear_n_lines(1)
+            if first_shown == 0:
+                continue
 
-        msg = get_gpt_msg(prompt, prev_chat)
-        print_ai_msg(msg, get_time_ms())
+            # Redraw with earlier messages
+            first_shown = max(first_shown - history_window * 2, 0)
+            redraw_chat()
+            flush_output()
+            continue
+
+        clear_n_lines(1)
+        send(prompt)
 
 
 def main():
@@ -412,28 +1295,61 @@ def main():
     init_prev_chats()
 
     # nicely formats args and prints help if needed
-    prompt, is_continue, is_new, is_interactive = get_args()
+    (
+        prompt,
+        is_continue,
+        is_new,
+        is_interactive,
+        is_search,
+        is_batch,
+        is_export,
+        is_import,
+    ) = get_args()
     has_prompt = len(prompt.strip()) > 0
 
+    # If the batch flag is passed, the prompt is the file of prompts
+    if is_batch:
+        # Imported here, as asyncio is slow to import and only batches need it
+        from batch import run_batch
+
+        run_batch(prompt.strip(), batch_format)
+
+    # If the export or import flag is passed, the prompt is the file to use
+    elif is_export:
+        run_export(prompt.strip(), batch_format)
+    elif is_import:
+        run_import(prompt.strip())
+
+    # If the search flag is passed, browse the chats matching the prompt
+    elif is_search:
+        browse_interface(prompt)
+
+    # If - or --stdin is passed, we reply about the text from stdin
+    elif read_stdin:
+        reply_to_piped(prompt)
+
     # If the user gives a prompt, we reply "inline"
-    if has_prompt and not is_interactive:
+    elif has_prompt and not is_interactive:
         # If the continue flag is passed, jump straight in there
         if is_continue:
             msg = get_gpt_msg(prompt, get_prev_chat(), no_frame=True)
-            print(get_markdown(msg, no_wrap=True))
+            if msg is not None and not stream_replies:
+                write_line(get_markdown(msg, no_wrap=True))
 
         # If new flag, start a new convo
         if is_new:
             msg = get_gpt_msg(prompt, None, no_frame=True)
-            print(get_markdown(msg, no_wrap=True))
+            if msg is not None and not stream_replies:
+                write_line(get_markdown(msg, no_wrap=True))
 
         # If the user has passed text, we generate a message
         # and give it back with no interface
         else:
             continued_chat = get_recent_conversation()
-            print("")
+            write_line("")
             msg = get_gpt_msg(prompt, continued_chat, no_frame=True)
-            print(get_markdown(msg, no_wrap=True))
+            if msg is not None and not stream_replies:
+                write_line(get_markdown(msg, no_wrap=True))
 
     # If the user has no prompt we enter the UI
     else:
@@ -449,6 +1365,8 @@ def main():
         elif prompt.strip() == "":
             browse_interface()
 
+    flush_output()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,206 @@
+"""
+Replying about text piped into hey (cat big.log | hey - summarise the errors).
+
+The text is read from stdin as it arrives and split at line breaks into chunks
+of up to chunk_tokens tokens. Each chunk is sent with the prompt as soon as it's
+read, up to pipe_concurrency at once, and the answers about each chunk are then
+combined into one reply. When there are too many answers to combine at once,
+they're combined in groups first, so text of any size can be piped in.
+
+Only the prompt and the final reply are saved, as one chat, not the piped text.
+"""
+
+import itertools
+import os
+import sys
+import threading
+import time
+from api import get_policy_texts
+from utils import count_tokens
+
+# Tokens of piped text sent in each request, set with HEY_CHUNK_TOKENS
+chunk_tokens = int(os.environ.get("HEY_CHUNK_TOKENS", 8000))
+
+# Requests in flight at once, set with HEY_PIPE_CONCURRENCY
+pipe_concurrency = int(os.environ.get("HEY_PIPE_CONCURRENCY", 4))
+
+map_instructions = (
+    "You're answering a question about a text too long to read at once, one part "
+    "at a time. Answer it for just this part, briefly, keeping any details that may "
+    "matter to the whole answer. If nothing in this part is relevant, say so in one line."
+)
+
+reduce_instructions = (
+    "You're given answers to a question about a long text, each about one part of it "
+    "in order. Combine them into one answer to the question, as if you'd read the "
+    "whole text. Leave out parts that had nothing relevant."
+)
+
+# Progress is written from the request threads, one line at a time
+progress_lock = threading.Lock()
+
+
+def iter_chunks(f):
+    """
+    Yields the text of the file in chunks of up to chunk_tokens tokens, split at
+    line breaks. Lines too long for a chunk are split too.
+    """
+    # At about 4 characters a token, so a line read never needs a chunk to itself
+    max_line_chars = max(1, chunk_tokens * 4)
+    chunk = []
+    tokens = 0
+
+    while True:
+        line = f.readline(max_line_chars)
+        if line == "":
+            break
+
+        line_tokens = count_tokens(line)
+        if len(chunk) > 0 and tokens + line_tokens > chunk_tokens:
+            yield "".join(chunk)
+            chunk = []
+            tokens = 0
+
+        chunk.append(line)
+        tokens += line_tokens
+
+    if len(chunk) > 0:
+        yield "".join(chunk)
+
+
+def print_progress(text):
+    """
+    Shows how far along the replies are on stderr, if it's a terminal.
+    """
+    if sys.stderr.isatty():
+        with progress_lock:
+            sys.stderr.write("\r\033[K" + text)
+            sys.stderr.flush()
+
+
+def get_map_messages(prompt, part, chunk):
+    return [
+        {"role": "system", "content": map_instructions},
+        {"role": "user", "content": prompt + "\n\nPart " + str(part) + ":\n\n" + chunk},
+    ]
+
+
+def get_reduce_messages(prompt, answers):
+    parts = [
+        "Answer about part " + str(i + 1) + ":\n" + answer
+        for i, answer in enumerate(answers)
+    ]
+    return [
+        {"role": "system", "content": reduce_instructions},
+        {
+            "role": "user",
+            "content": "Question: " + prompt + "\n\n" + "\n\n".join(parts),
+        },
+    ]
+
+
+def answer_all(requests, timeout, on_answer=None):
+    """
+    Gets the reply to each list of messages, up to pipe_concurrency at once, and
+    returns the replies in order. Requests are only taken from the iterable when a
+    slot is free, so piped text is read no faster than it's sent.
+    The first request to fail stops any more being made, and its error is raised.
+    """
+    workers = max(1, pipe_concurrency)
+    slots = threading.BoundedSemaphore(workers)
+    replies = {}
+    errors = []
+
+    def answer(index, messages):
+        try:
+            texts = get_policy_texts(messages, deadline=time.monotonic() + timeout)
+            replies[index] = "".join(texts)
+            if on_answer:
+                on_answer(len(replies))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            slots.release()
+
+    count = 0
+    for messages in requests:
+        slots.acquire()
+        if len(errors) > 0:
+            slots.release()
+            break
+        threading.Thread(target=answer, args=(count, messages), daemon=True).start()
+        count += 1
+
+    # Every slot is free again once the last reply is in
+    for _ in range(workers):
+        slots.acquire()
+
+    if len(errors) > 0:
+        raise errors[0]
+    return [replies[i] for i in range(count)]
+
+
+def get_answer_groups(answers):
+    """
+    Groups the answers so each group fits in a request, at least two to a group so
+    there are fewer after each round of combining.
+    """
+    groups = [[]]
+    tokens = 0
+    for answer in answers:
+        answer_tokens = count_tokens(answer)
+        if len(groups[-1]) > 1 and tokens + answer_tokens > chunk_tokens:
+            groups.append([])
+            tokens = 0
+        groups[-1].append(answer)
+        tokens += answer_tokens
+    return groups
+
+
+def get_piped_messages(prompt, f, timeout):
+    """
+    Answers the prompt about each chunk of the piped text, combining the answers
+    until they fit in one request. Returns the messages for the final reply, which
+    is just the prompt and the text if it fits in one chunk.
+    """
+    chunks = iter_chunks(f)
+    first = next(chunks, "")
+    second = next(chunks, None)
+    if second is None:
+        return [{"role": "user", "content": prompt + "\n\n" + first}]
+
+    state = {"read": 0, "answered": 0}
+
+    def show_progress():
+        print_progress(
+            "Answered "
+            + str(state["answered"])
+            + " of "
+            + str(state["read"])
+            + " parts read..."
+        )
+
+    def get_requests():
+        for chunk in itertools.chain([first, second], chunks):
+            state["read"] += 1
+            show_progress()
+            yield get_map_messages(prompt, state["read"], chunk)
+
+    def on_answer(count):
+        state["answered"] = count
+        show_progress()
+
+    try:
+        answers = answer_all(get_requests(), timeout, on_answer)
+
+        groups = get_answer_groups(answers)
+        while len(groups) > 1:
+            print_progress("Combining " + str(len(answers)) + " answers...")
+            answers = answer_all(
+                (get_reduce_messages(prompt, group) for group in groups), timeout
+            )
+            groups = get_answer_groups(answers)
+    finally:
+        print_progress("")
+
+    return get_reduce_messages(prompt, answers)
@@ -0,0 +1,258 @@
+"""
+Finding past exchanges related to a prompt (hey --related).
+
+Each exchange, a prompt and its reply, is turned into a hashed term vector and
+appended to the vectors file next to the chat history (utils.related_vectors_path,
+passed in as vectors_path), with its chat and time kept in the related_rows table
+of the chat db. Searching memory maps the file and
+scores every exchange with one matrix product per chunk of rows, so it stays fast
+with hundreds of thousands of them. The inverse document frequencies are applied
+to the query rather than stored, so they're always up to date.
+
+Vectors are written without numpy, so saving a chat doesn't pay for importing it,
+but searching needs numpy and finds nothing if it isn't installed.
+"""
+
+import math
+import os
+import re
+import zlib
+
+# Words are hashed into this many dimensions. Vectors are unit length, and each
+# dimension is stored as a byte from -127 to 127, as numpy turns bytes into floats
+# much faster than 16 bit floats
+dims = 512
+row_bytes = dims
+scale = 127
+
+# Rows of the vectors file scored at a time, small enough to stay in the cpu cache
+chunk_rows = 8192
+
+# Exchanges scoring less than this aren't related enough to show
+min_score = 0.2
+
+stop_words = set(
+    "a an and are as at be but by can do does for from have how i if in is it its "
+    "me my no not of on or so that the there this to was what when where which who "
+    "why will with would you your".split()
+)
+
+# numpy, imported on the first search, False if it isn't installed
+np = None
+
+
+def get_numpy():
+    global np
+    if np is None:
+        try:
+            import numpy
+
+            np = numpy
+        except ImportError:
+            np = False
+    return np
+
+
+def get_word_weights(text):
+    """
+    Returns the hashed term weights of some text, as a dict of dimension to weight.
+    Each word adds 1 + log(count) to its dimension, with a sign from its hash so
+    words that share a dimension tend to cancel out rather than add up.
+    """
+    counts = {}
+    for word in re.findall(r"\w+", text.lower()):
+        if len(word) > 1 and word not in stop_words:
+            counts[word] = counts.get(word, 0) + 1
+
+    weights = {}
+    for word, count in counts.items():
+        word_hash = zlib.crc32(word.encode("utf-8"))
+        dim = word_hash % dims
+        sign = 1 if word_hash & 0x80000000 else -1
+        weights[dim] = weights.get(dim, 0) + sign * (1 + math.log(count))
+    return weights
+
+
+def get_unit_weights(weights):
+    """
+    Returns the word weights scaled to make a unit length vector.
+    """
+    norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+    if norm == 0:
+        return weights
+    return {dim: weight / norm for dim, weight in weights.items()}
+
+
+def get_vector_bytes(weights):
+    """
+    Returns the unit length vector of the word weights as a row of the vectors file.
+    """
+    row = bytearray(row_bytes)
+    for dim, weight in get_unit_weights(weights).items():
+        row[dim] = round(weight * scale) & 0xFF
+    return bytes(row)
+
+
+def get_query_vector(weights, doc_freqs, doc_count):
+    """
+    Returns the vector a query is scored with, its word weights scaled by the square
+    of their inverse document frequency. Scoring stored term vectors with it weights
+    each shared word by its idf on both sides, like comparing tf-idf vectors.
+    """
+    scaled = {}
+    for dim, weight in weights.items():
+        idf = math.log((1 + doc_count) / (1 + doc_freqs.get(dim, 0))) + 1
+        scaled[dim] = weight * idf * idf
+
+    vector = [0.0] * dims
+    for dim, weight in get_unit_weights(scaled).items():
+        vector[dim] = weight
+    return vector
+
+
+def get_doc_stats(db):
+    """
+    Returns how many exchanges have each dimension, and how many exchanges there are.
+    """
+    doc_freqs = dict(db.execute("SELECT dim, docs FROM related_terms"))
+    doc_count = db.execute("SELECT count(*) FROM related_rows").fetchone()[0]
+    return doc_freqs, doc_count
+
+
+def get_exchanges(messages):
+    """
+    Pairs each user message with the assistant reply after it.
+    """
+    return [
+        (msg, reply)
+        for msg, reply in zip(messages, messages[1:])
+        if msg["role"] == "user" and reply["role"] == "assistant"
+    ]
+
+
+def add_exchanges(db, vectors_path, chat_id, messages):
+    """
+    Adds a vector for each exchange in the messages to the index. Should be called
+    inside a write transaction, whose lock keeps other processes from writing the
+    same rows.
+    """
+    exchanges = get_exchanges(messages)
+    if len(exchanges) == 0:
+        return
+
+    vectors = []
+    for prompt, reply in exchanges:
+        weights = get_word_weights(prompt["content"] + "\n" + reply["content"])
+        vector = get_vector_bytes(weights)
+        vectors.append(vector)
+
+        # Only the dimensions stored as non-zero are counted, as forget_rows does
+        db.executemany(
+            """
+            INSERT INTO related_terms (dim, docs) VALUES (?, 1)
+            ON CONFLICT (dim) DO UPDATE SET docs = docs + 1
+            """,
+            [(dim,) for dim in weights if vector[dim] != 0],
+        )
+
+    rows = []
+    with open(vectors_path, "r+b" if os.path.exists(vectors_path) else "w+b") as f:
+        # Start after the last whole row, a row cut short by a crash is written over
+        row = math.ceil(f.seek(0, os.SEEK_END) / row_bytes)
+        f.seek(row * row_bytes)
+        for (prompt, reply), vector in zip(exchanges, vectors):
+            f.write(vector)
+            rows.append((row, chat_id, prompt["time"]))
+            row += 1
+
+    db.executemany(
+        "INSERT INTO related_rows (row, chat_id, time) VALUES (?, ?, ?)", rows
+    )
+
+
+def forget_rows(db, vectors_path, rows):
+    """
+    Zeroes the vectors of rows and removes them from the index, so they never match.
+    Their dimensions are taken off the document frequencies, so the idf stays right.
+    Should be called inside a write transaction.
+    """
+    if len(rows) == 0 or not os.path.exists(vectors_path):
+        return
+
+    forgotten_docs = {}
+    with open(vectors_path, "r+b") as f:
+        for row in rows:
+            f.seek(row * row_bytes)
+            vector = f.read(row_bytes)
+            for dim, value in enumerate(vector):
+                if value != 0:
+                    forgotten_docs[dim] = forgotten_docs.get(dim, 0) + 1
+
+            f.seek(row * row_bytes)
+            f.write(bytes(row_bytes))
+
+    db.executemany(
+        "UPDATE related_terms SET docs = docs - ? WHERE dim = ?",
+        [(docs, dim) for dim, docs in forgotten_docs.items()],
+    )
+    db.execute("DELETE FROM related_terms WHERE docs <= 0")
+    db.executemany("DELETE FROM related_rows WHERE row = ?", [(row,) for row in rows])
+
+
+def clear_index(db, vectors_path):
+    """
+    Empties the index. Should be called inside a write transaction.
+    """
+    db.execute("DELETE FROM related_rows")
+    db.execute("DELETE FROM related_terms")
+    with open(vectors_path, "wb"):
+        pass
+
+
+def find_related(db, vectors_path, text, limit=10):
+    """
+    Returns up to limit (chat id, prompt time, score) of the exchanges most like the
+    text, best first. Returns nothing if numpy isn't installed.
+    """
+    np = get_numpy()
+    if not np or not os.path.exists(vectors_path):
+        return []
+
+    row_count = os.path.getsize(vectors_path) // row_bytes
+    weights = get_word_weights(text)
+    if row_count == 0 or len(weights) == 0:
+        return []
+
+    doc_freqs, doc_count = get_doc_stats(db)
+    query = np.array(get_query_vector(weights, doc_freqs, doc_count), dtype=np.float32)
+    matrix = np.memmap(vectors_path, dtype=np.int8, mode="r", shape=(row_count, dims))
+    query /= scale
+
+    # Keep extra candidates from each chunk, as some rows may have been forgotten
+    candidates = limit * 4
+    best_rows = []
+    best_scores = []
+    for start in range(0, row_count, chunk_rows):
+        scores = matrix[start : start + chunk_rows].astype(np.float32) @ query
+        if len(scores) > candidates:
+            top = np.argpartition(-scores, candidates)[:candidates]
+        else:
+            top = np.arange(len(scores))
+        top = top[scores[top] >= min_score]
+        best_rows.extend((top + start).tolist())
+        best_scores.extend(scores[top].tolist())
+
+    ranked = sorted(zip(best_scores, best_rows), reverse=True)[:candidates]
+    if len(ranked) == 0:
+        return []
+
+    rows = {
+        row: (chat_id, time)
+        for row, chat_id, time in db.execute(
+            "SELECT row, chat_id, time FROM related_rows WHERE row IN (%s)"
+            % ",".join("?" * len(ranked)),
+            [row for score, row in ranked],
+        )
+    }
+    related = [rows[row] + (score,) for score, row in ranked if row in rows]
+    return related[:limit]
@@ -0,0 +1,436 @@
+"""
+A small markdown to terminal renderer, used in place of glow by default.
+
+It covers what chat replies tend to use: headings, paragraphs, lists, block
+quotes, code blocks, tables, rules and inline code, emphasis and links.
+"""
+
+import functools
+import re
+import unicodedata
+import color as c
+
+# Bump when the output changes, so cached renders from older versions are not reused
+renderer_version = 3
+
+ansi_escape = re.compile(r"\x1B[@-_][0-?]*[ -/]*[@-~]")
+
+# Characters that join or modify the one before rather than taking up a column
+zero_width_chars = set("\u200b\u200c\u200d\u2060\ufe0e\ufe0f")
+
+inline_pattern = re.compile(
+    r"(`[^`]+`"
+    r"|\*\*[^*]+\*\*"
+    r"|__[^_]+__"
+    r"|(?<![\w*])\*[^*\s][^*]*\*(?![\w*])"
+    r"|(?<!\w)_[^_\s][^_]*_(?!\w)"
+    r"|\[[^\]]+\]\([^)]+\))"
+)
+link_pattern = re.compile(r"\[([^\]]+)\]\(([^)]+)\)")
+
+heading_pattern = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+list_pattern = re.compile(r"^(\s*)([-*+]|\d+[.)])\s+(.*)$")
+rule_pattern = re.compile(r"^\s*([-*_])(\s*\1){2,}\s*$")
+fence_pattern = re.compile(r"^\s*(```|~~~)")
+table_divider_pattern = re.compile(r"^\s*\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?\s*$")
+
+
+def char_width(char):
+    """
+    Returns how many columns a character takes up in the terminal, 2 for wide ones
+    like CJK and most emoji, 0 for combining marks and joiners.
+    """
+    if char < "\u0300":
+        return 1
+    if char in zero_width_chars or unicodedata.combining(char):
+        return 0
+    if unicodedata.east_asian_width(char) in "WF":
+        return 2
+    return 1
+
+
+def visible_length(s):
+    """
+    Returns how many columns a string takes up in the terminal, ignoring its styles.
+    """
+    s = ansi_escape.sub("", s)
+    if s.isascii():
+        return len(s)
+    return sum(char_width(char) for char in s)
+
+
+def split_at_width(text, width):
+    """
+    Splits unstyled text after as many characters as fit in the width. At least one
+    character is taken while there's width, so a wide one can't hold up wrapping.
+    """
+    if width <= 0:
+        return "", text
+    if text.isascii():
+        return text[:width], text[width:]
+
+    used = 0
+    for i, char in enumerate(text):
+        used += char_width(char)
+        if used > width:
+            i = max(i, 1)
+            return text[:i], text[i:]
+    return text, ""
+
+
+def code(str):
+    return c.cyan(str)
+
+
+def style_inline(text):
+    """
+    Splits a line of markdown into (text, style) pieces for its inline formatting.
+    """
+    pieces = []
+    for part in inline_pattern.split(text):
+        if part == "":
+            continue
+        if part.startswith("`") and part.endswith("`") and len(part) > 1:
+            pieces.append((part[1:-1], code))
+        elif (part.startswith("**") or part.startswith("__")) and len(part) > 4:
+            pieces.append((part[2:-2], c.bold))
+        elif part[0] in "*_" and part[-1] == part[0] and len(part) > 2:
+            pieces.append((part[1:-1], c.italic))
+        elif link_pattern.fullmatch(part):
+            label, url = link_pattern.fullmatch(part).groups()
+            pieces.append((label, c.bold))
+            if url != label:
+                pieces.append((" (" + url + ")", c.grey))
+        else:
+            pieces.append((part, None))
+
+    return pieces
+
+
+def render_inline(text):
+    """
+    Renders the inline formatting of a line without wrapping it.
+    """
+    return "".join(style(part) if style else part for part, style in style_inline(text))
+
+
+def get_words(text, width):
+    """
+    Splits inline markdown into styled words as (rendered, visible length) pairs.
+    Words longer than the width are broken up so they can still be wrapped.
+    """
+    words = []
+    word = ""
+    word_length = 0
+
+    for part, style in style_inline(text):
+        chunks = re.split(r"(\s+)", part)
+        for chunk in chunks:
+            if chunk == "":
+                continue
+            if chunk.isspace():
+                if word_length > 0:
+                    words.append((word, word_length))
+                word = ""
+                word_length = 0
+                continue
+
+            length = visible_length(chunk)
+            while word_length + length > width > 0:
+                head, chunk = split_at_width(chunk, width - word_length)
+                word += style(head) if style else head
+                words.append((word, word_length + visible_length(head)))
+                word = ""
+                word_length = 0
+                length = visible_length(chunk)
+
+            word += style(chunk) if style else chunk
+            word_length += length
+
+    if word_length > 0:
+        words.append((word, word_length))
+
+    return words
+
+
+def wrap(text, width, first_indent="", indent=""):
+    """
+    Wraps inline markdown to the width, returning the rendered lines.
+    """
+    line_width = max(1, width - len(indent))
+    lines = []
+    line = first_indent
+    line_length = 0
+
+    for word, length in get_words(text, line_width):
+        if line_length > 0 and line_length + 1 + length > line_width:
+            lines.append(line)
+            line = indent
+            line_length = 0
+
+        if line_length > 0:
+            line += " "
+            line_length += 1
+        line += word
+        line_length += length
+
+    lines.append(line)
+    return lines
+
+
+def render_table(rows, width):
+    """
+    Renders table rows with the columns padded to line up. If the table is too wide,
+    the widest columns are narrowed and their cells wrapped to fit the width.
+    """
+    cells = []
+    for row in rows:
+        row = row.strip()
+        if row.startswith("|"):
+            row = row[1:]
+        if row.endswith("|"):
+            row = row[:-1]
+        cells.append([cell.strip() for cell in row.split("|")])
+
+    num_cols = max(len(row) for row in cells)
+    col_widths = [1] * num_cols
+    for row in cells:
+        for i, cell in enumerate(row):
+            col_widths[i] = max(col_widths[i], visible_length(render_inline(cell)))
+
+    # Columns are kept apart by 3 characters
+    available = width - 3 * (num_cols - 1)
+    while sum(col_widths) > available and max(col_widths) > 1:
+        widest = col_widths.index(max(col_widths))
+        col_widths[widest] -= 1
+
+    lines = []
+    for row_num, row in enumerate(cells):
+        cell_lines = [
+            wrap(row[i] if i < len(row) else "", col_widths[i]) for i in range(num_cols)
+        ]
+        for line_num in range(max(len(cell) for cell in cell_lines)):
+            line = []
+            for i in range(num_cols):
+                cell = cell_lines[i][line_num] if line_num < len(cell_lines[i]) else ""
+                cell += " " * (col_widths[i] - visible_length(cell))
+                line.append(c.bold(cell) if row_num == 0 else cell)
+            lines.append(c.grey(" │ ").join(line))
+
+        if row_num == 0:
+            lines.append(c.grey("─┼─".join("─" * w for w in col_widths)))
+
+    return lines
+
+
+def parse_blocks(lines):
+    """
+    Splits the lines of markdown into blocks, which don't depend on the width.
+    """
+    blocks = []
+    paragraph = []
+    i = 0
+
+    def flush_paragraph():
+        if len(paragraph) > 0:
+            blocks.append(("paragraph", " ".join(paragraph)))
+            paragraph.clear()
+
+    while i < len(lines):
+        line = lines[i]
+        stripped = line.strip()
+
+        # Fenced code blocks are kept as is
+        if fence_pattern.match(line):
+            flush_paragraph()
+            fence = fence_pattern.match(line).group(1)
+            code_lines = []
+            i += 1
+            while i < len(lines) and not lines[i].strip().startswith(fence):
+                code_lines.append(lines[i].rstrip().replace("\t", "    "))
+                i += 1
+            blocks.append(("code", tuple(code_lines)))
+
+        elif stripped == "":
+            flush_paragraph()
+
+        elif heading_pattern.match(stripped):
+            flush_paragraph()
+            level, text = heading_pattern.match(stripped).groups()
+            text = ansi_escape.sub("", render_inline(text))
+            blocks.append(("heading", len(level), text))
+
+        elif rule_pattern.match(line):
+            flush_paragraph()
+            blocks.append(("rule",))
+
+        elif stripped.startswith("|") and (
+            i + 1 < len(lines) and table_divider_pattern.match(lines[i + 1])
+        ):
+            flush_paragraph()
+            rows = [line]
+            i += 2
+            while i < len(lines) and lines[i].strip().startswith("|"):
+                rows.append(lines[i])
+                i += 1
+            blocks.append(("table", tuple(rows)))
+            continue
+
+        elif stripped.startswith(">"):
+            flush_paragraph()
+            quote = []
+            while i < len(lines) and lines[i].strip().startswith(">"):
+                quote.append(lines[i].strip()[1:].strip())
+                i += 1
+            blocks.append(("quote", parse_blocks(quote)))
+            continue
+
+        elif list_pattern.match(line):
+            flush_paragraph()
+            items = []
+            while i < len(lines) and list_pattern.match(lines[i]):
+                spaces, marker, text = list_pattern.match(lines[i]).groups()
+                depth = len(spaces.replace("\t", "    ")) // 2
+                bullet = "•" if marker[0] in "-*+" else marker
+                i += 1
+
+                # Lines carrying on the list item without a marker
+                while (
+                    i < len(lines)
+                    and lines[i].strip() != ""
+                    and lines[i].startswith(" ")
+                    and not list_pattern.match(lines[i])
+                ):
+                    text += " " + lines[i].strip()
+                    i += 1
+
+                items.append(("  " * depth + bullet + " ", text))
+
+            blocks.append(("list", tuple(items)))
+            continue
+
+        else:
+            paragraph.append(stripped)
+
+        i += 1
+
+    flush_paragraph()
+    return tuple(blocks)
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_markdown(msg):
+    """
+    Parses a message into blocks once, however many widths it's laid out at.
+    """
+    return parse_blocks(msg.split("\n"))
+
+
+def layout_blocks(blocks, width):
+    """
+    Lays parsed blocks out as lines of styled terminal text no wider than the width.
+    """
+    width = max(width, 1)
+    output = []
+
+    for block in blocks:
+        kind = block[0]
+
+        # Code is only broken up if too wide
+        if kind == "code":
+            code_width = max(1, width - 2)
+            for code_line in block[1]:
+                while visible_length(code_line) > code_width:
+                    head, code_line = split_at_width(code_line, code_width)
+                    output.append("  " + code(head))
+                output.append("  " + code(code_line))
+
+        elif kind == "paragraph":
+            output.extend(wrap(block[1], width))
+
+        elif kind == "heading":
+            level, text = block[1], block[2]
+            if level == 1:
+                for heading_line in wrap(text, width - 2):
+                    output.append(c.purple_bg(" " + heading_line + " "))
+            else:
+                for heading_line in wrap(text, width):
+                    output.append(c.bold(c.purple(heading_line)))
+
+        elif kind == "rule":
+            output.append(c.grey("─" * width))
+
+        elif kind == "table":
+            output.extend(render_table(block[1], width))
+
+        elif kind == "quote":
+            quote = "\n".join(layout_blocks(block[1], width - 2)).strip("\n")
+            for quote_line in quote.split("\n"):
+                output.append(c.grey("│ ") + quote_line)
+
+        elif kind == "list":
+            for prefix, text in block[1]:
+                output.extend(wrap(text, width, c.grey(prefix), " " * len(prefix)))
+
+        # Blocks are kept apart by a blank line
+        if len(output) > 0 and output[-1] != "":
+            output.append("")
+
+    return output
+
+
+def render_markdown(msg, width):
+    """
+    Renders markdown into lines of styled terminal text no wider than the width.
+    """
+    return "\n".join(layout_blocks(parse_markdown(msg), width)).strip("\n")
+
+
+def rewrap(text, width):
+    """
+    Wraps lines that were already rendered, like glow's, to a narrower width. Lines
+    are broken between words keeping their indent and styles, so a resized terminal
+    can be redrawn without rendering again. Lines are never joined back up.
+    """
+    output = []
+    for line in text.split("\n"):
+        if visible_length(line) <= width:
+            output.append(line)
+            continue
+
+        parts = re.split(r"( +)", line)
+        indent = ""
+        if len(parts) > 1 and parts[0] == "":
+            indent = parts[1]
+            parts = parts[2:]
+
+        new_line = indent
+        line_length = len(indent)
+        gap = ""
+        for part in parts:
+            if part.startswith(" "):
+                gap = part
+                continue
+
+            # Styles with no text, like the reset after glow's padding, stay put
+            length = visible_length(part)
+            if length == 0:
+                new_line += part
+                continue
+
+            if line_length > len(indent) and line_length + len(gap) + length > width:
+                output.append(new_line)
+                new_line = indent
+                line_length = len(indent)
+                gap = ""
+
+            if line_length > len(indent):
+                new_line += gap
+                line_length += len(gap)
+            new_line += part
+            line_length += length
+            gap = ""
+
+        output.append(new_line)
+
+    return "\n".join(output)
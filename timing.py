@@ -0,0 +1,129 @@
+"""
+Timing of hey's phases, shown with --profile or HEY_PROFILE=1.
+
+Phases are recorded as named spans. When profiling, a table of them is printed
+to stderr on exit, and if HEY_TRACE_FILE is set each span is also appended to
+that file as a line of json, so many runs can be gathered up and compared.
+"""
+
+import atexit
+import functools
+import json
+import os
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+
+enabled = False
+trace_path = os.environ.get("HEY_TRACE_FILE")
+
+# Spans recorded so far as (name, start ms, duration ms), start is since the first import
+spans = []
+start_time = time.perf_counter()
+
+
+def add_span(name, start):
+    """
+    Records a span that started at start (a time.perf_counter value) and ends now.
+    """
+    end = time.perf_counter()
+    spans.append((name, (start - start_time) * 1000, (end - start) * 1000))
+
+
+@contextmanager
+def span(name):
+    """
+    Records the time spent inside the with block as a span.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_span(name, start)
+
+
+def timed(name):
+    """
+    Decorator recording each call to the function as a span.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def enable():
+    """
+    Turns profiling on, so the spans are reported when hey exits.
+    """
+    global enabled
+    if not enabled:
+        enabled = True
+        atexit.register(report)
+
+
+def report():
+    print_summary()
+    if trace_path:
+        write_trace()
+
+
+def print_summary():
+    """
+    Prints the count, total, mean and max time of each span name to stderr.
+    """
+    totals = {}
+    for name, start, duration in spans:
+        if name not in totals:
+            totals[name] = []
+        totals[name].append(duration)
+
+    lines = [
+        "",
+        "%-22s %6s %10s %10s %10s" % ("phase", "calls", "total", "mean", "max"),
+    ]
+    for name, durations in sorted(totals.items(), key=lambda item: -sum(item[1])):
+        lines.append(
+            "%-22s %6d %8.1fms %8.1fms %8.1fms"
+            % (
+                name,
+                len(durations),
+                sum(durations),
+                sum(durations) / len(durations),
+                max(durations),
+            )
+        )
+    lines.append(
+        "%-22s %6s %8.1fms" % ("total", "", (time.perf_counter() - start_time) * 1000)
+    )
+    print("\n".join(lines), file=sys.stderr)
+
+
+def write_trace():
+    """
+    Appends the spans of this run to the trace file, a line of json each.
+    """
+    run_id = str(uuid.uuid4())
+    run_time = int(time.time() * 1000)
+    with open(trace_path, "a") as f:
+        for name, start, duration in spans:
+            record = {
+                "run": run_id,
+                "time": run_time,
+                "argv": sys.argv[1:],
+                "span": name,
+                "start_ms": round(start, 3),
+                "duration_ms": round(duration, 3),
+            }
+            f.write(json.dumps(record) + "\n")
+
+
+if os.environ.get("HEY_PROFILE"):
+    enable()
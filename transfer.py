@@ -0,0 +1,140 @@
+"""
+Moving chat history between machines (hey --export / hey --import).
+
+Chats are exported one at a time, as a line of json each or as markdown, and
+imported by parsing the file a piece at a time, so neither needs more memory
+than the biggest chat, however big the history is. Imported chats are merged
+into the saved chat with the same id, skipping messages saved at the same time.
+"""
+
+import json
+import sys
+from utils import get_chat_ids, get_chat_messages, get_formatted_datetime, merge_chat
+
+# Characters read from the import file at a time
+chunk_size = 64 * 1024
+
+
+def iter_json_objects(f):
+    """
+    Yields each json object in a file as it is read, whether the file is a json array
+    of them (like the old prev_chats.json) or has one on each line (like --export).
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    is_eof = False
+
+    while True:
+        # Skip the whitespace, commas and brackets between objects
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,[]":
+            pos += 1
+
+        if pos == len(buffer):
+            if is_eof:
+                return
+            buffer = f.read(chunk_size)
+            pos = 0
+            is_eof = buffer == ""
+            continue
+
+        try:
+            obj, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # The object may just not have been read in full yet
+            if is_eof:
+                raise
+            more = f.read(max(chunk_size, len(buffer) - pos))
+            buffer = buffer[pos:] + more
+            pos = 0
+            is_eof = more == ""
+            continue
+
+        yield obj
+        pos = end
+
+
+def get_markdown_chat(chat_id, messages):
+    lines = ["# Chat from " + get_formatted_datetime(messages[0]["time"]), ""]
+    for msg in messages:
+        name = "You" if msg["role"] == "user" else "hey"
+        lines.append("### " + name + ", " + get_formatted_datetime(msg["time"]))
+        lines.append("")
+        lines.append(msg["content"])
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+
+def export_chats(f, output_format="jsonl"):
+    """
+    Writes every saved chat to the file, one at a time, as jsonl or markdown.
+    Returns how many chats were written.
+    """
+    count = 0
+    for chat_id in get_chat_ids():
+        messages = get_chat_messages(chat_id)
+        if len(messages) == 0:
+            continue
+
+        if output_format == "markdown":
+            f.write(get_markdown_chat(chat_id, messages))
+        else:
+            f.write(json.dumps({"id": chat_id, "messages": messages}) + "\n")
+        count += 1
+
+    return count
+
+
+def import_chats(f):
+    """
+    Merges each chat in the file into the saved chats as it is read.
+    Returns how many chats were read and how many messages were added.
+    """
+    chat_count = 0
+    message_count = 0
+    for chat in iter_json_objects(f):
+        messages = [
+            msg
+            for msg in chat.get("messages", [])
+            if "role" in msg and "content" in msg and "time" in msg
+        ]
+        if "id" not in chat or len(messages) == 0:
+            continue
+
+        message_count += merge_chat(chat["id"], messages)
+        chat_count += 1
+
+    return chat_count, message_count
+
+
+def run_export(path="", output_format="jsonl"):
+    """
+    Exports the chats to the file at path, or stdout if no path is given.
+    """
+    if not path:
+        export_chats(sys.stdout, output_format)
+        return
+
+    with open(path, "w") as f:
+        count = export_chats(f, output_format)
+    print("Exported " + str(count) + (" chat" if count == 1 else " chats"))
+
+
+def run_import(path=""):
+    """
+    Imports the chats from the file at path, or stdin if no path is given.
+    """
+    if path:
+        with open(path, "r") as f:
+            chat_count, message_count = import_chats(f)
+    else:
+        chat_count, message_count = import_chats(sys.stdin)
+
+    print(
+        "Added "
+        + str(message_count)
+        + (" message" if message_count == 1 else " messages")
+        + " from "
+        + str(chat_count)
+        + (" chat" if chat_count == 1 else " chats")
+    )
@@ -1,27 +1,87 @@
-import pandas as pd
 import color as c
+import related
+from render import visible_length
+from timing import timed
 import sys
 import termios
 import tty
 import re
+import atexit
 import datetime
+import shutil
 import random
 import json
+import hashlib
+import sqlite3
 import uuid
 import os
 import math
+import zlib
 
 CLEAR_RIGHT = "\033[K"  # clean to the right of the cursor
 PREV_LINE = "\033[F"  # move cursor to the beginning of previous line
 HIDE_CURSOR = "\033[?25l"  # hide cursor
 SHOW_CURSOR = "\033[?25h"  # show cursor
+CLEAR_SCREEN = "\033[2J\033[H"  # clear the visible screen, keeping the scrollback
 
-# Save location for previous chats
+# Save location for previous chats, next to the script unless HEY_DATA_DIR is set
 script_dir = os.path.dirname(os.path.abspath(__file__))
-data_json_path = file_path = os.path.join(script_dir, "prev_chats.json")
+data_dir = os.environ.get("HEY_DATA_DIR", script_dir)
+data_db_path = os.path.join(data_dir, "prev_chats.db")
 
-# Number of columns in the terminal
-cols = int(os.popen("stty size", "r").read().split()[1])
+# Chats used to be kept in one json file, it is migrated into the db on first run
+data_json_path = os.path.join(data_dir, "prev_chats.json")
+
+# Vectors of past exchanges for --related, see related.py
+related_vectors_path = os.path.join(data_dir, "related_vectors.bin")
+
+db_connection = None
+
+# Several hey processes can write to the dbs at once (eg: one per tmux pane). Each
+# write is one short transaction, so a process waits at most this many seconds for
+# another's to finish
+db_timeout = 10
+
+# Rendered markdown and api responses are cached in their own db, each
+# trimmed back when it grows past its size
+cache_db_path = os.path.join(data_dir, "cache.db")
+max_render_cache_bytes = 20 * 1024 * 1024
+max_response_cache_bytes = 5 * 1024 * 1024
+
+# Renders used more recently than this aren't marked as used again, so most cache
+# hits don't need to write
+render_touch_ms = 60 * 60 * 1000
+
+# Recent time to first token of requests are kept to decide when to hedge
+max_latency_samples = 200
+min_latency_samples = 20
+
+cache_connection = None
+
+# Chats not updated in this many days are moved out of the messages table into
+# compressed archive segments, one or more per month
+archive_after_days = int(os.environ.get("HEY_ARCHIVE_DAYS", 30))
+
+# Decompressed archive segments by id. Segments aren't changed once written,
+# except by pruning, so they're safe to keep. Only the last few used are kept
+segment_cache = {}
+max_cached_segments = 4
+
+# Characters of messages put in an archive segment before starting another
+max_segment_bytes = 4 * 1024 * 1024
+
+# Tokenizer for count_tokens, False if tiktoken isn't installed
+token_encoding = None
+
+# Number of columns in the terminal, kept up to date by update_terminal_size
+cols = shutil.get_terminal_size().columns
+
+# Timezone chat times are shown in, set with HEY_TIMEZONE (eg: Pacific/Auckland)
+# If not set the system's local timezone is used
+timezone_name = os.environ.get("HEY_TIMEZONE")
+
+# Prompt for user_input, moving up into its frame
+input_prompt = c.bold(c.blue("\033[1A\033[2C"))
 
 # Formatting options for textwraps
 msg_width = cols - (10 if cols > 80 else 4)
@@ -29,96 +89,960 @@ msg_width = cols - (10 if cols > 80 else 4)
 # Data Loading Utils ============================================================
 
 
-def init_prev_chats():
-    if not os.path.exists(data_json_path):
-        with open(data_json_path, "w") as f:
-            json.dump([], f)
+# Longest first message kept in the chat index, the browse menu trims it to fit
+max_index_preview = 1000
 
 
-def reset_prev_chats():
-    with open(data_json_path, "w") as f:
-        json.dump([], f)
+def get_db():
+    """
+    Returns the connection to the chat history db, creating its tables if needed.
+    """
+    global db_connection
+    if db_connection is None:
+        # Write transactions take the lock when they begin rather than at their first
+        # write, so two processes never both read then fail to upgrade to writing
+        db_connection = sqlite3.connect(
+            data_db_path, timeout=db_timeout, isolation_level="IMMEDIATE"
+        )
 
+        # With WAL readers don't block writers, and a crash mid write can't
+        # leave the db half written
+        db_connection.execute("PRAGMA journal_mode = WAL")
+        db_connection.execute("PRAGMA synchronous = NORMAL")
+        tables = [
+            row[0]
+            for row in db_connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+        ]
+
+        db_connection.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                chat_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                time INTEGER NOT NULL,
+                meta TEXT
+            );
+            CREATE INDEX IF NOT EXISTS messages_chat ON messages (chat_id);
+            CREATE INDEX IF NOT EXISTS messages_time ON messages (time);
+
+            CREATE TABLE IF NOT EXISTS chats (
+                id TEXT PRIMARY KEY,
+                preview TEXT NOT NULL,
+                first_time INTEGER NOT NULL,
+                last_time INTEGER NOT NULL,
+                message_count INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS chats_last_time ON chats (last_time);
+
+            CREATE TABLE IF NOT EXISTS summaries (
+                chat_id TEXT PRIMARY KEY,
+                message_count INTEGER NOT NULL,
+                summary TEXT NOT NULL
+            );
+
+            CREATE TABLE IF NOT EXISTS archive_segments (
+                id INTEGER PRIMARY KEY,
+                month TEXT NOT NULL,
+                chat_count INTEGER NOT NULL,
+                message_count INTEGER NOT NULL,
+                data BLOB NOT NULL
+            );
+
+            CREATE TABLE IF NOT EXISTS archived_chats (
+                chat_id TEXT NOT NULL,
+                segment_id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS archived_chats_chat ON archived_chats (chat_id);
+            CREATE INDEX IF NOT EXISTS archived_chats_segment ON archived_chats (segment_id);
+
+            CREATE TABLE IF NOT EXISTS related_rows (
+                row INTEGER PRIMARY KEY,
+                chat_id TEXT NOT NULL,
+                time INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS related_rows_chat ON related_rows (chat_id);
+
+            CREATE TABLE IF NOT EXISTS related_terms (
+                dim INTEGER PRIMARY KEY,
+                docs INTEGER NOT NULL
+            );
+
+            CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5 (
+                content,
+                chat_id UNINDEXED,
+                tokenize = 'porter unicode61'
+            );
+            """)
+
+        # Dbs made before messages had metadata need the column added
+        columns = [
+            row[1] for row in db_connection.execute("PRAGMA table_info(messages)")
+        ]
+        if "meta" not in columns:
+            db_connection.execute("ALTER TABLE messages ADD COLUMN meta TEXT")
+
+        # Dbs made before the indexes existed need them filled in once
+        if "chats" not in tables:
+            rebuild_chat_index()
+        if "message_search" not in tables:
+            rebuild_search_index()
+        if "related_rows" not in tables or not os.path.exists(related_vectors_path):
+            rebuild_related_index()
+
+    return db_connection
+
+
+def rebuild_chat_index():
+    """
+    Rebuilds the chat summaries used by the browse menu from the saved messages.
+    """
+    db = get_db()
+    with db:
+        db.execute("DELETE FROM chats")
+        db.execute(
+            """
+            INSERT INTO chats (id, preview, first_time, last_time, message_count)
+            SELECT
+                chat_id,
+                (SELECT substr(first.content, 1, ?) FROM messages AS first
+                 WHERE first.chat_id = messages.chat_id ORDER BY first.rowid LIMIT 1),
+                min(time),
+                max(time),
+                count(*)
+            FROM messages
+            GROUP BY chat_id
+            """,
+            (max_index_preview,),
+        )
 
-def get_saved_chats():
-    chats = []
-    if os.path.exists(data_json_path):
-        with open(data_json_path, "r") as f:
-            chats = json.load(f)
 
-    # Sort by most recently updated
-    chats = sorted(chats, key=lambda chat: chat["messages"][-1]["time"])
-    chats.reverse()
+def rebuild_search_index():
+    """
+    Rebuilds the full text search index from the saved messages.
+    """
+    db = get_db()
+    with db:
+        db.execute("DELETE FROM message_search")
+        db.execute(
+            "INSERT INTO message_search (content, chat_id) SELECT content, chat_id FROM messages"
+        )
 
-    return chats
 
+def rebuild_related_index():
+    """
+    Rebuilds the index of exchanges used to find related chats from the saved chats.
+    """
+    db = get_db()
+    with db:
+        db.execute("BEGIN IMMEDIATE")
+        related.clear_index(db, related_vectors_path)
+        for chat_id in list(get_chat_ids()):
+            related.add_exchanges(
+                db, related_vectors_path, chat_id, get_chat_messages(chat_id)
+            )
 
-def get_prev_chat(chat_id=None):
+
+def insert_messages(db, chat_id, messages):
     """
-    Retrieves the most recent chat history from the 'prev_chats.json' file.
+    Saves messages to a chat, updating the chat index, search index and related
+    index to match. Should be called inside a transaction.
     """
-    # Read the original data
-    chats = []
+    db.executemany(
+        "INSERT INTO messages (chat_id, role, content, time, meta) VALUES (?, ?, ?, ?, ?)",
+        [
+            (
+                chat_id,
+                msg["role"],
+                msg["content"],
+                msg["time"],
+                json.dumps(msg["meta"]) if msg.get("meta") else None,
+            )
+            for msg in messages
+        ],
+    )
+    db.executemany(
+        "INSERT INTO message_search (content, chat_id) VALUES (?, ?)",
+        [(msg["content"], chat_id) for msg in messages],
+    )
+    index_chat_messages(db, chat_id, messages)
+    related.add_exchanges(db, related_vectors_path, chat_id, messages)
+
+
+def index_chat_messages(db, chat_id, messages):
+    """
+    Updates the summary of a chat in the chat index with newly saved messages.
+    """
+    db.execute(
+        """
+        INSERT INTO chats (id, preview, first_time, last_time, message_count)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET
+            last_time = max(last_time, excluded.last_time),
+            message_count = message_count + excluded.message_count
+        """,
+        (
+            chat_id,
+            messages[0]["content"][0:max_index_preview],
+            min(msg["time"] for msg in messages),
+            max(msg["time"] for msg in messages),
+            len(messages),
+        ),
+    )
+
+
+@timed("init_prev_chats")
+def init_prev_chats():
+    """
+    Makes the chat history db, moving chats over from the old json file if there is one,
+    and archives chats that haven't been updated in a while.
+    """
+    db = get_db()
     if os.path.exists(data_json_path):
+        migrate_json_chats(db)
+
+    archive_old_chats()
+
+
+def migrate_json_chats(db):
+    """
+    Moves the chats in the old json file into the db, a chat at a time.
+    """
+    # Imported here as transfer imports utils
+    from transfer import iter_json_objects
+
+    with db:
+        # Take the write lock before looking at the file again, so if two processes
+        # start at once only the first moves the chats over
+        db.execute("BEGIN IMMEDIATE")
+        if not os.path.exists(data_json_path):
+            return
+
         with open(data_json_path, "r") as f:
-            chats = json.load(f)
+            for chat in iter_json_objects(f):
+                if len(chat["messages"]) > 0:
+                    insert_messages(db, chat["id"], chat["messages"])
 
-    if chat_id:
-        # Find the chat with the given ID
-        for chat in chats:
-            if chat["id"] == chat_id:
-                return chat
-    else:
-        # Find the most recent chat
-        most_recent_chat = chats[0]
-        for chat in chats[1:]:
-            if chat["messages"][-1]["time"] > most_recent_chat["messages"][-1]["time"]:
-                most_recent_chat = chat
+        # Keep the old file around, but out of the way. This happens before the
+        # commit, so if it fails the chats aren't moved over twice
+        os.replace(data_json_path, data_json_path + ".bak")
 
-        return most_recent_chat
 
+def get_chat_messages(chat_id):
+    """
+    Returns the messages of a chat in the order they were saved, including any
+    that have been archived.
+    """
+    db = get_db()
+    messages = []
+    for (segment_id,) in db.execute(
+        "SELECT segment_id FROM archived_chats WHERE chat_id = ? ORDER BY segment_id",
+        (chat_id,),
+    ):
+        messages += get_archive_segment(segment_id).get(chat_id, [])
+
+    return messages + get_hot_messages(db, chat_id)
 
-def save_chat(prompt, reply, user_time, ai_time, prev_id=None):
+
+def get_hot_messages(db, chat_id):
     """
-    Saves the user prompt and assistant reply in the chat history.
+    Returns the messages of a chat that are still in the messages table, ie not archived.
+    Messages with metadata (eg: the request attempts of a reply) have it under "meta".
     """
-    # Read the original data
-    chats = []
-    if os.path.exists(data_json_path):
-        with open(data_json_path, "r") as f:
-            chats = json.load(f)
+    messages = []
+    for role, content, time, meta in db.execute(
+        "SELECT role, content, time, meta FROM messages WHERE chat_id = ? ORDER BY rowid",
+        (chat_id,),
+    ):
+        msg = {"role": role, "content": content, "time": time}
+        if meta:
+            msg["meta"] = json.loads(meta)
+        messages.append(msg)
+    return messages
+
+
+@timed("get_chat_index")
+def get_chat_index():
+    """
+    Returns a summary of every saved chat, most recently updated first.
+    Each has the chat id, a preview of its first message, its first and last
+    message times and its message count, without loading any message bodies.
+    """
+    rows = get_db().execute("""
+        SELECT id, preview, first_time, last_time, message_count
+        FROM chats ORDER BY last_time DESC
+        """)
+    return format_chat_index(rows)
 
-    if prev_id:
-        # Find the most recent chat
-        prev_chat = None
-        for chat in chats:
-            if chat["id"] == prev_id:
-                prev_chat = chat
-                break
 
-        # Append the new data
-        prev_chat["messages"].append(
-            {"role": "user", "content": prompt, "time": user_time},
-        )
-        prev_chat["messages"].append(
-            {"role": "assistant", "content": reply, "time": ai_time}
+def format_chat_index(rows):
+    """
+    Turns rows of the chats table into chat summary dicts.
+    """
+    return [
+        {
+            "id": chat_id,
+            "preview": preview,
+            "first_time": first_time,
+            "last_time": last_time,
+            "message_count": message_count,
+        }
+        for chat_id, preview, first_time, last_time, message_count in rows
+    ]
+
+
+@timed("search_chats")
+def search_chats(terms, limit=100):
+    """
+    Returns summaries of the chats with a message containing all of the search terms,
+    best match first. Each word also matches words it is the start of.
+    """
+    words = re.findall(r"\w+", terms)
+    if len(words) == 0:
+        return []
+
+    query = " ".join('"' + word + '"*' for word in words)
+    rows = get_db().execute(
+        """
+        SELECT chats.id, preview, first_time, last_time, message_count
+        FROM (
+            SELECT chat_id, min(rank) AS score FROM message_search
+            WHERE message_search MATCH ? GROUP BY chat_id
+        ) AS hits
+        JOIN chats ON chats.id = hits.chat_id
+        ORDER BY hits.score
+        LIMIT ?
+        """,
+        (query, limit),
+    )
+    return format_chat_index(rows)
+
+
+@timed("get_prev_chat")
+def get_prev_chat(chat_id=None):
+    """
+    Retrieves a chat from the history, or the most recently updated one if no id is given.
+    """
+    if not chat_id:
+        # Find the most recent chat
+        row = (
+            get_db()
+            .execute("SELECT id FROM chats ORDER BY last_time DESC LIMIT 1")
+            .fetchone()
         )
+        if row is None:
+            return None
+        chat_id = row[0]
 
-    else:
-        # Append the new data
-        chats.append(
-            {
-                "id": str(uuid.uuid4()),
-                "messages": [
+    messages = get_chat_messages(chat_id)
+    if len(messages) == 0:
+        return None
+
+    return {"id": chat_id, "messages": messages}
+
+
+@timed("save_chat")
+def save_chat(prompt, reply, user_time, ai_time, prev_id=None, meta=None):
+    """
+    Saves the user prompt and assistant reply in the chat history, with the reply's
+    metadata if given. Returns the id of the chat they were saved to.
+    """
+    chat_id = prev_id if prev_id else str(uuid.uuid4())
+    messages = [
+        {"role": "user", "content": prompt, "time": user_time},
+        {"role": "assistant", "content": reply, "time": ai_time, "meta": meta},
+    ]
+
+    db = get_db()
+    with db:
+        insert_messages(db, chat_id, messages)
+
+    return chat_id
+
+
+@timed("save_chats")
+def save_chats(exchanges):
+    """
+    Saves many prompt and reply exchanges at once, each as a new chat, in one write.
+    Each exchange is a (prompt, reply, user_time, ai_time) tuple. Returns the chat ids.
+    """
+    chat_ids = []
+    db = get_db()
+    with db:
+        for prompt, reply, user_time, ai_time in exchanges:
+            chat_id = str(uuid.uuid4())
+            insert_messages(
+                db,
+                chat_id,
+                [
                     {"role": "user", "content": prompt, "time": user_time},
                     {"role": "assistant", "content": reply, "time": ai_time},
                 ],
+            )
+            chat_ids.append(chat_id)
+
+    return chat_ids
+
+
+def get_chat_ids():
+    """
+    Yields the id of every saved chat, oldest first, without loading them all at once.
+    """
+    for (chat_id,) in (
+        get_db().cursor().execute("SELECT id FROM chats ORDER BY first_time")
+    ):
+        yield chat_id
+
+
+def merge_chat(chat_id, messages):
+    """
+    Adds messages to a saved chat, or saves them as a new chat if there isn't one with
+    the id. Messages at the same time as one already in the chat are skipped.
+    Returns how many messages were added.
+    """
+    db = get_db()
+    with db:
+        db.execute("BEGIN IMMEDIATE")
+        saved = get_chat_messages(chat_id)
+        times = set(msg["time"] for msg in saved)
+
+        new_messages = []
+        for msg in sorted(messages, key=lambda msg: msg["time"]):
+            if msg["time"] not in times:
+                times.add(msg["time"])
+                new_messages.append(msg)
+        if len(new_messages) == 0:
+            return 0
+
+        if len(saved) == 0 or new_messages[0]["time"] > saved[-1]["time"]:
+            insert_messages(db, chat_id, new_messages)
+        else:
+            # The new messages go between saved ones, so the chat is saved again
+            # in order. It moves out of the archive until it is next archived
+            related.forget_rows(
+                db,
+                related_vectors_path,
+                [
+                    row
+                    for (row,) in db.execute(
+                        "SELECT row FROM related_rows WHERE chat_id = ?", (chat_id,)
+                    )
+                ],
+            )
+            for table, column in [
+                ("messages", "chat_id"),
+                ("message_search", "chat_id"),
+                ("summaries", "chat_id"),
+                ("archived_chats", "chat_id"),
+                ("chats", "id"),
+            ]:
+                db.execute(f"DELETE FROM {table} WHERE {column} = ?", (chat_id,))
+            insert_messages(
+                db, chat_id, sorted(saved + new_messages, key=lambda msg: msg["time"])
+            )
+
+    return len(new_messages)
+
+
+@timed("get_related_chats")
+def get_related_chats(text, limit=100):
+    """
+    Returns summaries of the chats with the exchanges most like the text, best first.
+    """
+    chat_ids = []
+    for chat_id, time, score in related.find_related(
+        get_db(), related_vectors_path, text, limit
+    ):
+        if chat_id not in chat_ids:
+            chat_ids.append(chat_id)
+    if len(chat_ids) == 0:
+        return []
+
+    rows = get_db().execute(
+        """
+        SELECT id, preview, first_time, last_time, message_count
+        FROM chats WHERE id IN (%s)
+        """ % ",".join("?" * len(chat_ids)),
+        chat_ids,
+    )
+    chats = format_chat_index(rows)
+    return sorted(chats, key=lambda chat: chat_ids.index(chat["id"]))
+
+
+@timed("get_related_exchanges")
+def get_related_exchanges(text, limit=3, exclude_chat_id=None):
+    """
+    Returns up to limit (prompt, reply) message pairs from saved chats most like the
+    text, best first, leaving out those from the excluded chat.
+    """
+    exchanges = []
+    for chat_id, time, score in related.find_related(
+        get_db(), related_vectors_path, text, limit * 3
+    ):
+        if chat_id == exclude_chat_id:
+            continue
+        for prompt, reply in related.get_exchanges(get_chat_messages(chat_id)):
+            if prompt["time"] == time:
+                exchanges.append((prompt, reply))
+                break
+        if len(exchanges) == limit:
+            break
+    return exchanges
+
+
+def get_chat_summary(chat_id):
+    """
+    Returns the summary of a chat's earlier messages as (message count, summary),
+    where the message count is how many messages from the start it covers.
+    """
+    row = (
+        get_db()
+        .execute(
+            "SELECT message_count, summary FROM summaries WHERE chat_id = ?", (chat_id,)
+        )
+        .fetchone()
+    )
+    if row is None:
+        return 0, ""
+    return row
+
+
+def save_chat_summary(chat_id, message_count, summary):
+    """
+    Saves the summary of a chat's first message_count messages.
+    """
+    db = get_db()
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO summaries (chat_id, message_count, summary) VALUES (?, ?, ?)",
+            (chat_id, message_count, summary),
+        )
+
+
+# Archive Utils =================================================================
+
+
+def get_archive_segment(segment_id):
+    """
+    Returns the chats in an archive segment, as a dict of chat id to messages.
+    """
+    if segment_id not in segment_cache:
+        row = (
+            get_db()
+            .execute("SELECT data FROM archive_segments WHERE id = ?", (segment_id,))
+            .fetchone()
+        )
+        if len(segment_cache) >= max_cached_segments:
+            del segment_cache[next(iter(segment_cache))]
+        segment_cache[segment_id] = json.loads(zlib.decompress(row[0])) if row else {}
+    return segment_cache[segment_id]
+
+
+def save_archive_segment(db, month, chats):
+    """
+    Writes chats, a dict of chat id to messages, as a new archive segment.
+    Should be called inside a transaction.
+    """
+    data = zlib.compress(json.dumps(chats).encode("utf-8"), 9)
+    segment_id = db.execute(
+        "INSERT INTO archive_segments (month, chat_count, message_count, data) VALUES (?, ?, ?, ?)",
+        (month, len(chats), sum(len(msgs) for msgs in chats.values()), data),
+    ).lastrowid
+    db.executemany(
+        "INSERT INTO archived_chats (chat_id, segment_id) VALUES (?, ?)",
+        [(chat_id, segment_id) for chat_id in chats],
+    )
+
+
+def get_archivable_chats(db, cutoff):
+    """
+    Returns (chat id, last message time) of each chat not updated since cutoff
+    that still has messages outside the archive.
+    """
+    return db.execute(
+        """
+        SELECT DISTINCT messages.chat_id, chats.last_time
+        FROM messages JOIN chats ON chats.id = messages.chat_id
+        WHERE messages.time < ? AND chats.last_time < ?
+        """,
+        (cutoff, cutoff),
+    ).fetchall()
+
+
+@timed("archive_old_chats")
+def archive_old_chats():
+    """
+    Moves the messages of chats not updated in archive_after_days into compressed
+    archive segments by month, keeping the messages table small. Months with a lot
+    of chats are split into segments of about max_segment_bytes. Archived chats
+    stay in the chat index and search index, so browse and search still find them.
+    """
+    cutoff = get_time_ms() - archive_after_days * 24 * 60 * 60 * 1000
+    db = get_db()
+    if len(get_archivable_chats(db, cutoff)) == 0:
+        return
+
+    with db:
+        # Check again with the write lock held, another process may have just done it
+        db.execute("BEGIN IMMEDIATE")
+        rows = sorted(get_archivable_chats(db, cutoff), key=lambda row: row[1])
+
+        month = None
+        chats = {}
+        size = 0
+        for chat_id, last_time in rows:
+            chat_month = datetime.datetime.fromtimestamp(
+                last_time / 1000, datetime.timezone.utc
+            ).strftime("%Y-%m")
+            if len(chats) > 0 and (chat_month != month or size >= max_segment_bytes):
+                move_to_archive(db, month, chats)
+                chats = {}
+                size = 0
+
+            month = chat_month
+            chats[chat_id] = get_hot_messages(db, chat_id)
+            size += sum(len(msg["content"]) for msg in chats[chat_id])
+
+        if len(chats) > 0:
+            move_to_archive(db, month, chats)
+
+
+def move_to_archive(db, month, chats):
+    """
+    Saves chats as a new archive segment and deletes their messages from the messages table.
+    """
+    save_archive_segment(db, month, chats)
+    db.executemany("DELETE FROM messages WHERE chat_id = ?", [(id,) for id in chats])
+
+
+@timed("prune_chats")
+def prune_chats(before_time=None):
+    """
+    Deletes the chats not updated since before_time, or every chat if it is None,
+    from the hot messages and the archive. Returns how many chats were deleted.
+    """
+    db = get_db()
+    with db:
+        db.execute("BEGIN IMMEDIATE")
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS pruned_chats (id TEXT PRIMARY KEY)")
+        db.execute("DELETE FROM pruned_chats")
+        if before_time is None:
+            db.execute("INSERT INTO pruned_chats SELECT id FROM chats")
+        else:
+            db.execute(
+                "INSERT INTO pruned_chats SELECT id FROM chats WHERE last_time < ?",
+                (before_time,),
+            )
+        pruned_count = db.execute("SELECT count(*) FROM pruned_chats").fetchone()[0]
+
+        related.forget_rows(
+            db,
+            related_vectors_path,
+            [
+                row
+                for (row,) in db.execute(
+                    "SELECT row FROM related_rows WHERE chat_id IN (SELECT id FROM pruned_chats)"
+                )
+            ],
+        )
+
+        for table, column in [
+            ("messages", "chat_id"),
+            ("message_search", "chat_id"),
+            ("summaries", "chat_id"),
+            ("chats", "id"),
+        ]:
+            db.execute(
+                f"DELETE FROM {table} WHERE {column} IN (SELECT id FROM pruned_chats)"
+            )
+
+        # Segments with some chats left are written again without the pruned ones
+        segments = db.execute("""
+            SELECT DISTINCT segment_id, month FROM archived_chats
+            JOIN archive_segments ON archive_segments.id = segment_id
+            WHERE chat_id IN (SELECT id FROM pruned_chats)
+            """).fetchall()
+        db.execute(
+            "DELETE FROM archived_chats WHERE chat_id IN (SELECT id FROM pruned_chats)"
+        )
+        for segment_id, month in segments:
+            chats = get_archive_segment(segment_id)
+            kept = {
+                chat_id: chats[chat_id]
+                for (chat_id,) in db.execute(
+                    "SELECT chat_id FROM archived_chats WHERE segment_id = ?",
+                    (segment_id,),
+                )
             }
+            db.execute("DELETE FROM archived_chats WHERE segment_id = ?", (segment_id,))
+            db.execute("DELETE FROM archive_segments WHERE id = ?", (segment_id,))
+            if len(kept) > 0:
+                save_archive_segment(db, month, kept)
+        segment_cache.clear()
+
+    # Give the freed space back
+    db.execute("VACUUM")
+    return pruned_count
+
+
+# Cache Utils ===================================================================
+
+
+def get_cache_db():
+    """
+    Returns the connection to the cache db, creating it if needed.
+    """
+    global cache_connection
+    if cache_connection is None:
+        cache_connection = sqlite3.connect(
+            cache_db_path, timeout=db_timeout, isolation_level="IMMEDIATE"
+        )
+
+        # Losing the last few writes to a crash is fine for a cache
+        cache_connection.execute("PRAGMA journal_mode = WAL")
+        cache_connection.execute("PRAGMA synchronous = OFF")
+        cache_connection.executescript("""
+            CREATE TABLE IF NOT EXISTS renders (
+                key TEXT PRIMARY KEY,
+                output TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS renders_last_used ON renders (last_used);
+
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                reply TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                time INTEGER NOT NULL,
+                last_used INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+
+            CREATE TABLE IF NOT EXISTS stats (
+                name TEXT PRIMARY KEY,
+                count INTEGER NOT NULL
+            );
+
+            CREATE TABLE IF NOT EXISTS latencies (
+                time INTEGER NOT NULL,
+                first_token_ms REAL NOT NULL
+            );
+            """)
+    return cache_connection
+
+
+def trim_cache_table(cache, table, max_bytes):
+    """
+    Evicts the least recently used rows of a cache table if it is too big.
+    It is trimmed to 3/4 of the limit so evictions don't happen every save.
+    """
+    total_size = cache.execute("SELECT sum(size) FROM " + table).fetchone()[0]
+    if total_size and total_size > max_bytes:
+        cache.execute(
+            f"""
+            DELETE FROM {table} WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, sum(size) OVER (ORDER BY last_used DESC) AS kept
+                    FROM {table}
+                ) WHERE kept > ?
+            )
+            """,
+            (max_bytes * 3 // 4,),
         )
 
-    # Write the new data
-    with open(data_json_path, "w") as f:
-        json.dump(chats, f)
+
+def get_render_key(msg, width, style):
+    """
+    Returns the cache key for a message rendered at a width in a style.
+    The style should include the renderer version so old renders are not reused.
+    """
+    key = style + "\0" + str(width) + "\0" + msg
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def get_cached_renders(keys):
+    """
+    Returns the cached render for each key, or None for those not rendered yet.
+    Renders last used over render_touch_ms ago are marked as used, in one write.
+    """
+    cache = get_cache_db()
+    found = {}
+    # Looked up in batches, as there's a limit on the parameters in a query
+    for start in range(0, len(keys), 500):
+        batch = keys[start : start + 500]
+        for key, output, last_used in cache.execute(
+            "SELECT key, output, last_used FROM renders WHERE key IN (%s)"
+            % ",".join("?" * len(batch)),
+            batch,
+        ):
+            found[key] = (output, last_used)
+
+    now = get_time_ms()
+    stale = [
+        (now, key)
+        for key, (output, last_used) in found.items()
+        if last_used < now - render_touch_ms
+    ]
+    if len(stale) > 0:
+        with cache:
+            cache.executemany("UPDATE renders SET last_used = ? WHERE key = ?", stale)
+
+    return [found[key][0] if key in found else None for key in keys]
+
+
+def get_cached_render(key):
+    """
+    Returns the cached render for the key, or None if it has not been rendered.
+    """
+    return get_cached_renders([key])[0]
+
+
+def save_cached_renders(renders):
+    """
+    Caches (key, output) renders in one write, evicting the least recently used
+    renders if the cache is too big.
+    """
+    if len(renders) == 0:
+        return
+    cache = get_cache_db()
+    now = get_time_ms()
+    with cache:
+        cache.executemany(
+            "INSERT OR REPLACE INTO renders (key, output, size, last_used) VALUES (?, ?, ?, ?)",
+            [(key, output, len(output), now) for key, output in renders],
+        )
+        trim_cache_table(cache, "renders", max_render_cache_bytes)
+
+
+def save_cached_render(key, output):
+    """
+    Caches a render, evicting the least recently used renders if the cache is too big.
+    """
+    save_cached_renders([(key, output)])
+
+
+def get_response_key(model, messages, params=None):
+    """
+    Returns the cache key for a request to the model with the messages and parameters.
+    """
+    request = {"model": model, "messages": messages, "params": params or {}}
+    key = json.dumps(request, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def get_cached_response(key, ttl):
+    """
+    Returns the cached reply for the key if it is younger than ttl seconds, else None.
+    Counts the lookup as a cache hit or miss.
+    """
+    cache = get_cache_db()
+    now = get_time_ms()
+    row = cache.execute(
+        "SELECT reply FROM responses WHERE key = ? AND time > ?",
+        (key, now - ttl * 1000),
+    ).fetchone()
+
+    with cache:
+        if row is not None:
+            cache.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (now, key)
+            )
+        cache.execute(
+            """
+            INSERT INTO stats (name, count) VALUES (?, 1)
+            ON CONFLICT (name) DO UPDATE SET count = count + 1
+            """,
+            ("response_hits" if row is not None else "response_misses",),
+        )
+
+    return row[0] if row is not None else None
+
+
+def save_cached_response(key, reply, ttl):
+    """
+    Caches a reply, dropping expired replies and evicting the least recently used
+    if the cache is too big.
+    """
+    cache = get_cache_db()
+    now = get_time_ms()
+    with cache:
+        cache.execute("DELETE FROM responses WHERE time <= ?", (now - ttl * 1000,))
+        cache.execute(
+            "INSERT OR REPLACE INTO responses (key, reply, size, time, last_used) VALUES (?, ?, ?, ?, ?)",
+            (key, reply, len(reply), now, now),
+        )
+        trim_cache_table(cache, "responses", max_response_cache_bytes)
+
+
+def get_response_cache_stats():
+    """
+    Returns the number of response cache hits and misses, and how many replies are cached.
+    """
+    cache = get_cache_db()
+    stats = dict(cache.execute("SELECT name, count FROM stats"))
+    cached = cache.execute("SELECT count(*) FROM responses").fetchone()[0]
+    return stats.get("response_hits", 0), stats.get("response_misses", 0), cached
+
+
+def save_request_latency(first_token_ms):
+    """
+    Records how long a request took to its first token, keeping only the most recent.
+    """
+    cache = get_cache_db()
+    with cache:
+        cache.execute(
+            "INSERT INTO latencies (time, first_token_ms) VALUES (?, ?)",
+            (get_time_ms(), first_token_ms),
+        )
+        cache.execute(
+            "DELETE FROM latencies WHERE rowid <= (SELECT max(rowid) FROM latencies) - ?",
+            (max_latency_samples,),
+        )
+
+
+def get_request_latency_percentile(percentile):
+    """
+    Returns the percentile of recent times to first token in ms, or None if there
+    aren't enough requests recorded yet to tell.
+    """
+    latencies = [
+        row[0]
+        for row in get_cache_db().execute(
+            "SELECT first_token_ms FROM latencies ORDER BY first_token_ms"
+        )
+    ]
+    if len(latencies) < min_latency_samples:
+        return None
+    index = min(len(latencies) - 1, math.ceil(len(latencies) * percentile / 100) - 1)
+    return latencies[index]
+
+
+# Output Utils ==================================================================
+
+# Printing helpers add to this buffer rather than writing straight to the terminal.
+# flush_output writes it all in one go, and is called before waiting on the user or
+# the network, so whole frames and history replays go out as a single write.
+output_buffer = []
+
+
+def write(text):
+    output_buffer.append(text)
+
+
+def write_line(line=""):
+    output_buffer.append(line + "\n")
+
+
+def flush_output():
+    if len(output_buffer) > 0:
+        sys.stdout.write("".join(output_buffer))
+        output_buffer.clear()
+    sys.stdout.flush()
+
+
+atexit.register(flush_output)
 
 
 # Message Style Utils =============================================================
@@ -132,11 +1056,15 @@ def get_time_str(time, color="yellow"):
         return c.yellow(time_str + " ")
 
 
+def print_ai_msg_header(time):
+    write_line("")
+    write_line(get_time_str(time, "yellow"))
+
+
 def print_ai_msg_frame(msg, time):
-    print("")
-    print(get_time_str(time, "yellow"))
+    print_ai_msg_header(time)
     for line in msg.split("\n"):
-        print(line)
+        write_line(line)
 
 
 def print_user_msg_frame(msg, time):
@@ -155,15 +1083,18 @@ def print_user_msg_frame(msg, time):
     text_padding = abs(text_width - bubble_width) * " "
     bubble_padding = (cols - bubble_width - bubble_inner) * " "
 
-    print("")
+    write_line("")
 
-    print(c.blue(bubble_padding + "╭" + time_padding) + time_str + c.blue("╮"))
+    write_line(c.blue(bubble_padding + "╭" + time_padding) + time_str + c.blue("╮"))
     if "\n" in msg:
         for line in msg.split("\n"):
-            print(bubble_padding + c.blue("│ ") + line + c.blue(" │"))
+            line_padding = max(text_width - get_visible_length(line), 0) * " "
+            write_line(
+                bubble_padding + c.blue("│ ") + line + line_padding + c.blue(" │")
+            )
     else:
-        print(bubble_padding + c.blue("│ ") + text_padding + msg + c.blue(" │"))
-    print(c.blue(bubble_padding + "╰─" + "─" * bubble_width + "─╯"))
+        write_line(bubble_padding + c.blue("│ ") + text_padding + msg + c.blue(" │"))
+    write_line(c.blue(bubble_padding + "╰─" + "─" * bubble_width + "─╯"))
 
 
 # Generic Utils ==================================================================
@@ -173,40 +1104,112 @@ def get_time_ms():
     return int(datetime.datetime.now().timestamp() * 1000)
 
 
+def parse_age_ms(age):
+    """
+    Turns an age like 12h, 180d, 4w or 1y into milliseconds, or None if it
+    can't be read. A bare number is taken as days.
+    """
+    match = re.fullmatch(r"(\d+)([hdwy]?)", age.strip().lower())
+    if match is None:
+        return None
+    hour = 60 * 60 * 1000
+    units = {
+        "h": hour,
+        "d": 24 * hour,
+        "": 24 * hour,
+        "w": 7 * 24 * hour,
+        "y": 365 * 24 * hour,
+    }
+    return int(match.group(1)) * units[match.group(2)]
+
+
 def clear_prompt():
-    print(f"{PREV_LINE}{CLEAR_RIGHT}")
+    write_line(f"{PREV_LINE}{CLEAR_RIGHT}")
+
+
+def get_local_time(ms):
+    """
+    Converts a time in ms to a datetime in the configured timezone, or the local one
+    if HEY_TIMEZONE isn't a timezone we know.
+    """
+    utc_time = datetime.datetime.fromtimestamp(ms / 1000, datetime.timezone.utc)
+    if timezone_name:
+        from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+        try:
+            return utc_time.astimezone(ZoneInfo(timezone_name))
+        except (ZoneInfoNotFoundError, ValueError):
+            pass
+    return utc_time.astimezone()
 
 
 def get_formatted_date(ms):
-    utc_time = pd.to_datetime(ms, unit="ms", utc=True)
-    local_time = utc_time.tz_convert("Pacific/Auckland")
+    local_time = get_local_time(ms)
     return local_time.strftime("%d %b'%y")
 
 
 def get_formatted_datetime(ms):
-    utc_time = pd.to_datetime(ms, unit="ms", utc=True)
-    local_time = utc_time.tz_convert("Pacific/Auckland")
+    local_time = get_local_time(ms)
     ampm = local_time.strftime("%p").lower()
 
     return local_time.strftime("%d %b'%y %I:%M") + ampm
 
 
+def print_input_frame(typed=""):
+    """
+    Prints the frame input is typed into. Anything already typed is printed in it,
+    for when the frame is redrawn in the middle of typing.
+    """
+    write_line("\n\n" + c.blue(c.bold(">")))
+    if typed:
+        write(input_prompt + typed)
+    flush_output()
+
+
 def user_input():
-    indent = cols - msg_width
-    print("\n\n" + c.blue(c.bold(">")))
-    result = input(c.bold(c.blue("\033[1A\033[2C")))
+    print_input_frame()
+    result = input(input_prompt)
     clear_n_lines(3)
     return result
 
 
 def fake_user_input():
-    print(c.bold(c.blue("\n>\n")))
+    write_line(c.bold(c.blue("\n>\n")))
+
+
+def count_tokens(text):
+    """
+    Counts the tokens in some text, with tiktoken if it is installed.
+    Otherwise it is estimated at about 4 characters a token.
+    """
+    global token_encoding
+    if token_encoding is None:
+        try:
+            import tiktoken
+
+            token_encoding = tiktoken.get_encoding("o200k_base")
+        except ImportError:
+            token_encoding = False
+
+    if token_encoding:
+        return len(token_encoding.encode(text))
+    return math.ceil(len(text) / 4)
 
 
 def get_visible_length(s):
-    ansi_escape = re.compile(r"\x1B[@-_][0-?]*[ -/]*[@-~]")
-    stripped_string = ansi_escape.sub("", s)
-    return len(stripped_string)
+    """
+    Returns how many columns a string takes up, counting wide characters as 2.
+    """
+    return visible_length(s)
+
+
+def update_terminal_size():
+    """
+    Measures the terminal again after it's been resized.
+    """
+    global cols, msg_width
+    cols = shutil.get_terminal_size().columns
+    msg_width = cols - (10 if cols > 80 else 4)
 
 
 def get_recent_conversation():
@@ -214,21 +1217,77 @@ def get_recent_conversation():
     If the last conversation was < 1 min ago, we auto continue
     Returns that chat if was less than 5 mins ago, else returns None
     """
-    chats = get_saved_chats()
-    if len(chats) > 0:
-        if chats[0]["messages"][-1]["time"] > (get_time_ms() - 1000 * 60 * 5):
-            return chats[0]
+    chat = get_prev_chat()
+    if chat:
+        if chat["messages"][-1]["time"] > (get_time_ms() - 1000 * 60 * 5):
+            return chat
 
     return None
 
 
+class Screen:
+    """
+    Draws a block of lines and redraws it in place, only rewriting the lines that
+    changed since the last draw. Each draw is sent to the terminal in one write.
+    The cursor is left on the line after the block.
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def draw(self, lines):
+        out = []
+        if len(self.lines) > 0:
+            # Back to the first line of the block
+            out.append(f"\033[{len(self.lines)}F")
+
+        skipped = 0
+        for i in range(max(len(lines), len(self.lines))):
+            line = lines[i] if i < len(lines) else ""
+            if i < len(self.lines) and self.lines[i] == line:
+                skipped += 1
+                continue
+
+            if skipped > 0:
+                out.append(f"\033[{skipped}E")
+                skipped = 0
+            out.append("\r" + CLEAR_RIGHT + line + "\n")
+
+        if skipped > 0:
+            out.append(f"\033[{skipped}E")
+
+        # If the block got shorter, end up right after its new last line
+        extra = len(self.lines) - len(lines)
+        if extra > 0:
+            out.append(f"\033[{extra}F")
+
+        self.lines = list(lines)
+        write("".join(out))
+        flush_output()
+
+    def clear(self):
+        """
+        Clears the block, leaving the cursor where its first line was.
+        """
+        self.draw([])
+
+    def redraw(self, lines):
+        """
+        Clears the screen and draws the block at the top of it, for when resizing
+        the terminal has moved the block's lines about.
+        """
+        self.lines = []
+        write(CLEAR_SCREEN)
+        self.draw(lines)
+
+
 def clear_n_lines(n):
     # Move the cursor up `n` lines
     for _ in range(n):
         # Move cursor up one line
-        sys.stdout.write("\033[F")
+        write("\033[F")
         # Clear the line
-        sys.stdout.write("\033[K")
+        write("\033[K")
 
 
 def print_goodbye():
@@ -256,7 +1315,8 @@ def print_goodbye():
     else:
         print_ai_msg_frame(random.choice(goodbye_phrases) + " 👋", get_time_ms())
 
-    print("")
+    write_line("")
+    flush_output()
 
 
 def center(str):
@@ -265,6 +1325,7 @@ def center(str):
 
 
 def get_key():
+    flush_output()
     fd = sys.stdin.fileno()
     old_settings = termios.tcgetattr(fd)
     try: